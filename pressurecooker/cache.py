@@ -0,0 +1,140 @@
+"""
+A content-addressed, on-disk cache for generated thumbnails.
+Cached thumbnails are keyed by the digest of the input file, the function that
+generated them and all the options it was called with, so re-running a chef on
+unchanged inputs copies (or hard-links) the previous outputs instead of
+regenerating them.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from .utils import make_dir_if_needed
+
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024    # 512MB of cached thumbnails
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_digest(fpath):
+    """
+    Return the sha256 hex digest of the contents of the file at `fpath`.
+    """
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ThumbnailCache(object):
+    """
+    Cache of thumbnails stored in `cache_dir`. When the cached files grow larger
+    than `max_size` bytes, the least recently used ones are evicted. The `hits`
+    and `misses` counters track how often thumbnails were served from the cache,
+    and `size` is the total size of the cached thumbnails in bytes.
+    """
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE, hardlink=False):
+        """
+        :param cache_dir: A string path to the directory holding cached thumbnails
+        :param max_size: The maximum total size of cached thumbnails, in bytes
+        :param hardlink: Hard-link cached thumbnails to the output path instead of
+                         copying them (falls back to copying across filesystems)
+        """
+        self.cache_dir = make_dir_if_needed(cache_dir)
+        self.max_size = max_size
+        self.hardlink = hardlink
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}
+        # kept up to date as thumbnails are stored, so the directory is only
+        # listed again when something has to be evicted
+        self.size = sum(size for _, size, _ in self._list_entries())
+
+    def get_key(self, func, fpath_in, fpath_out, **options):
+        """
+        Return the cache key for the thumbnail `func(fpath_in, fpath_out, **options)`.
+        The extension of `fpath_out` is part of the key since it selects the
+        output image format.
+        """
+        stat = os.stat(fpath_in)
+        digest_key = (os.path.abspath(fpath_in), stat.st_size, stat.st_mtime)
+        if digest_key not in self._digests:
+            self._digests[digest_key] = get_file_digest(fpath_in)
+        key = json.dumps({
+            'digest': self._digests[digest_key],
+            'function': '{}.{}'.format(func.__module__, func.__name__),
+            'options': options,
+            'ext': os.path.splitext(fpath_out)[1].lower(),
+        }, sort_keys=True, default=repr)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def generate(self, func, fpath_in, fpath_out, **options):
+        """
+        Write the thumbnail `func(fpath_in, fpath_out, **options)` to `fpath_out`,
+        from the cache if possible. Errors raised by `func` are passed through.
+
+        :return: The path `fpath_out`
+        """
+        cached_path = os.path.join(self.cache_dir, self.get_key(func, fpath_in, fpath_out, **options))
+        if os.path.exists(cached_path):
+            self.hits += 1
+            os.utime(cached_path, None)  # mark as recently used
+            self._copy(cached_path, fpath_out)
+            return fpath_out
+
+        self.misses += 1
+        func(fpath_in, fpath_out, **options)
+        # copy to a temporary file first so other processes never see partial files
+        temp_fh, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(temp_fh)
+        shutil.copyfile(fpath_out, temp_path)
+        os.rename(temp_path, cached_path)
+        self.size += os.path.getsize(cached_path)
+        if self.size > self.max_size:
+            self.evict()
+        return fpath_out
+
+    def evict(self):
+        """
+        Remove the least recently used thumbnails until the cache fits in `max_size`.
+        The directory is listed again, which also picks up the thumbnails stored or
+        evicted by other processes sharing the cache.
+        """
+        entries = self._list_entries()
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # already evicted by another process
+            total_size -= size
+        self.size = total_size
+
+    def _list_entries(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # evicted by another process
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _copy(self, cached_path, fpath_out):
+        if os.path.exists(fpath_out):
+            os.remove(fpath_out)
+        if self.hardlink:
+            try:
+                os.link(cached_path, fpath_out)
+                return
+            except (OSError, AttributeError):
+                pass
+        shutil.copyfile(cached_path, fpath_out)
@@ -0,0 +1,18 @@
+"""
+Exceptions raised by pressurecooker. They are kept in this dependency-free module
+so they can be imported (and caught) without loading any media libraries.
+"""
+
+
+class ThumbnailGenerationError(Exception):
+    """
+    Custom error returned when thumbnail extraction process fails.
+    """
+    pass
+
+
+class VideoCompressionError(Exception):
+    """
+    Custom error returned when `ffmpeg` compression exits with a non-zero status.
+    """
+    pass
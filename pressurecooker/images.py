@@ -1,30 +1,36 @@
+"""
+Thumbnail generation for the different content kinds.
+Heavy dependencies (numpy, matplotlib, PIL, ebooklib, pdf2image) are imported
+by the functions that use them, so importing this module stays cheap.
+"""
 import math
 import tempfile
-import numpy as np
 import os
+import re
+import shutil
+import struct
 import wave
 import subprocess
 import sys
-import matplotlib
 import zipfile
-import ebooklib
-import ebooklib.epub
 from io import BytesIO
 
-# Set the backend to avoid platform-specific differences in MPLBACKEND
-matplotlib.use("PS")
+from .exceptions import ThumbnailGenerationError
+from .utils import run_in_process_pool
 
-import matplotlib.pyplot as plt
-from matplotlib.figure import Figure
-from matplotlib.colors import LinearSegmentedColormap
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from pdf2image import convert_from_path
-from PIL import Image, ImageOps
 
-from le_utils.constants import file_formats
-
-from .thumbscropping import scale_and_crop
 
+def _get_colormap(cmap_name):
+    """
+    Look up the matplotlib colormap `cmap_name` without importing pyplot.
+    """
+    import matplotlib
+    import matplotlib.cm
+    try:
+        return matplotlib.colormaps[cmap_name]
+    except AttributeError:
+        # matplotlib < 3.5
+        return matplotlib.cm.get_cmap(cmap_name)
 
 
 # SMARTCROP UTILS
@@ -37,25 +43,104 @@ def scale_and_crop_thumbnail(image, size=THUMBNAIL_SIZE, crop="smart", **kwargs)
     Scale and crop the PIL Image ``image`` to maximum dimensions of ``size``.
     By default, ``crop`` is set to "smart" which will crop the image down to size
     based on the entropy content of the pixels. The other options are:
+    * Use ``crop="smart-fast"`` for a faster, single-pass entropy crop
     * Use ``crop="0,0"`` to crop from the left and top edges
     * Use ``crop=",0"`` to crop from the top edge.
     Optional keyword arguments:
     * ``zoom=X``: crop outer X% before starting
     * ``target``: recenter here before cropping (default center ``(50, 50)``)
+    * ``prescale=True``: decode JPEGs at a reduced scale before resizing
     See the ``scale_and_crop`` docs in ``thumbscropping.py`` for more details.
     """
+    from .thumbscropping import scale_and_crop
     return scale_and_crop(image, size, crop=crop, upscale=True, **kwargs)
 
 
 
+# IMAGE SIZE PROBING
+################################################################################
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+JPEG_SOF_MARKERS = set([0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                        0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF])
+PROBE_MAX_BYTES = 128 * 1024
+
+def get_image_size(fhandle, max_bytes=PROBE_MAX_BYTES):
+    """
+    Read the ``(width, height)`` of the PNG or JPEG image in the binary file
+    object ``fhandle`` from its header (PNG IHDR chunk or JPEG SOF marker)
+    without decoding the image. Reads at most ``max_bytes`` and returns None
+    if the file isn't a PNG or JPEG, or if the size can't be found.
+    """
+    header = fhandle.read(len(PNG_SIGNATURE))
+    if header == PNG_SIGNATURE:
+        ihdr = fhandle.read(16)
+        if len(ihdr) < 16 or ihdr[4:8] != b'IHDR':
+            return None
+        return struct.unpack('>II', ihdr[8:16])
+    if header[:2] != b'\xff\xd8':
+        return None
+    data = bytearray(header[2:])
+    bytes_read = len(header)
+    position = 0
+    while bytes_read < max_bytes:
+        # make sure the marker and the first 7 bytes of its segment are available
+        while len(data) - position < 9 and bytes_read < max_bytes:
+            chunk = fhandle.read(4096)
+            if not chunk:
+                break
+            data.extend(chunk)
+            bytes_read += len(chunk)
+        if len(data) - position < 2 or data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # fill byte before the marker
+            position += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            # standalone markers without a length
+            position += 2
+            continue
+        if len(data) - position < 4:
+            return None
+        length = struct.unpack('>H', bytes(data[position + 2:position + 4]))[0]
+        if marker in JPEG_SOF_MARKERS:
+            if len(data) - position < 9:
+                return None
+            height, width = struct.unpack('>HH', bytes(data[position + 5:position + 9]))
+            return width, height
+        # skip over the segment, reading past the end of the buffer if needed
+        position += 2 + length
+        if position > len(data):
+            if bytes_read + position - len(data) > max_bytes:
+                return None
+            skip = fhandle.read(position - len(data))
+            bytes_read += len(skip)
+            if len(data) + len(skip) < position:
+                return None
+            data = bytearray()
+            position = 0
+        else:
+            del data[:position]
+            position = 0
+    return None
+
+
+
 # THUMBNAILS FOR CONTENT KINDS
 ################################################################################
 
-def create_image_from_epub(epubfile, fpath_out, crop=None):
+def create_image_from_epub(epubfile, fpath_out, crop=None, prescale=True):
     """
     Generate a thumbnail image from `epubfile` and save it to `fpath_out`.
+    JPEG images are decoded at a reduced scale unless `prescale` is False.
     Raises ThumbnailGenerationError if thumbnail extraction fails.
     """
+    import ebooklib
+    import ebooklib.epub
+    from PIL import Image
+
     try:
         book = ebooklib.epub.read_epub(epubfile)
         # 1. try to get cover image from book metadata (content.opf)
@@ -79,17 +164,20 @@ def create_image_from_epub(epubfile, fpath_out, crop=None):
 
         # Save image_data to fpath_out
         im = Image.open(image_data)
-        im = scale_and_crop_thumbnail(im, crop=crop)
+        im = scale_and_crop_thumbnail(im, crop=crop, prescale=prescale)
         im.save(fpath_out)
     except Exception as e:
         raise ThumbnailGenerationError("Fail on ePub {} {}".format(epubfile, e))
 
 
-def create_image_from_zip(htmlfile, fpath_out, crop="smart"):
+def create_image_from_zip(htmlfile, fpath_out, crop="smart", prescale=True):
     """
     Create an image from the html5 zip at htmlfile and write result to fpath_out.
+    JPEG images are decoded at a reduced scale unless `prescale` is False.
     Raises ThumbnailGenerationError if thumbnail extraction fails.
     """
+    from PIL import Image
+
     biggest_name = None
     size = 0
     try:
@@ -101,78 +189,292 @@ def create_image_from_zip(htmlfile, fpath_out, crop="smart"):
                 ext = dotext[1:]
                 if ext in image_exts:
                     with zf.open(filename) as fhandle:
-                        image_data = fhandle.read()
-                        with BytesIO(image_data) as bhandle:
-                            img = Image.open(bhandle)
-                            img_size = img.size[0] * img.size[1]
-                            if img_size > size:
-                                biggest_name = filename
-                                size = img_size
+                        img_size = get_image_size(fhandle)
+                    if img_size is None:
+                        # header not recognized, let PIL work it out
+                        with zf.open(filename) as fhandle:
+                            with BytesIO(fhandle.read()) as bhandle:
+                                img_size = Image.open(bhandle).size
+                    img_size = img_size[0] * img_size[1]
+                    if img_size > size:
+                        biggest_name = filename
+                        size = img_size
             if biggest_name is None:
                 raise ThumbnailGenerationError("HTML5 zip file {} contains no images.".format(htmlfile))
             with zf.open(biggest_name) as fhandle:
                 image_data = fhandle.read()
                 with BytesIO(image_data) as bhandle:
                     img = Image.open(bhandle)
-                    img = scale_and_crop_thumbnail(img, crop=crop)
+                    img = scale_and_crop_thumbnail(img, crop=crop, prescale=prescale)
                     img.save(fpath_out)
     except Exception as e:
         raise ThumbnailGenerationError("Fail on zip {} {}".format(htmlfile, e))
 
 
-def create_image_from_pdf_page(fpath_in, fpath_out, page_number=0, crop=None):
+PDF_MAX_DPI = 500
+PDF_PAGE_SIZE_RE = re.compile(r'Page\s+(?:\d+\s+)?size:\s+([\d.]+) x ([\d.]+)')
+PDF_PAGE_ROT_RE = re.compile(r'Page\s+(?:\d+\s+)?rot:\s+(\d+)')
+
+def get_pdf_page_size(fpath_in, page_number=1):
+    """
+    Return the ``(width, height)`` in points (1/72 inch) of the page `page_number`
+    of the pdf at fpath_in as reported by `pdfinfo`, or None if it is unknown.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                ['pdfinfo', '-f', str(page_number), '-l', str(page_number), fpath_in],
+                stderr=devnull)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    output = output.decode('utf-8', 'replace')
+    size_match = PDF_PAGE_SIZE_RE.search(output)
+    if size_match is None:
+        return None
+    width, height = float(size_match.group(1)), float(size_match.group(2))
+    rot_match = PDF_PAGE_ROT_RE.search(output)
+    if rot_match and int(rot_match.group(1)) % 180 == 90:
+        width, height = height, width
+    return width, height
+
+
+def get_pdf_thumbnail_dpi(fpath_in, page_number=1, size=THUMBNAIL_SIZE, zoom=0):
+    """
+    Return the lowest resolution at which page `page_number` of the pdf at
+    fpath_in covers `size` after clipping the `zoom` percentage off of it, so
+    the page never has to be upscaled. Falls back to `PDF_MAX_DPI` if the page
+    size can't be determined.
+    """
+    page_size = get_pdf_page_size(fpath_in, page_number=page_number)
+    if not page_size or not all(page_size):
+        return PDF_MAX_DPI
+    scale = (100 + int(zoom)) / 100.0
+    dpi = 72.0 * scale * max(size[0] / page_size[0], size[1] / page_size[1])
+    return max(1, min(PDF_MAX_DPI, int(math.ceil(dpi))))
+
+
+def create_image_from_pdf_page(fpath_in, fpath_out, page_number=0, crop=None, dpi=None):
     """
     Create an image from the pdf at fpath_in and write result to fpath_out.
+    Only page `page_number` is rendered, at `dpi` or, by default, at the lowest
+    resolution needed for the thumbnail (see `get_pdf_thumbnail_dpi`).
     """
+    from pdf2image import convert_from_path
+
+    zoom = 10
+    page_number = max(1, page_number)  # pdf pages are numbered from 1
+    temp_dir = tempfile.mkdtemp()
     try:
         assert fpath_in.endswith('pdf'), "File must be in pdf format"
-        pages = convert_from_path(fpath_in, 500, first_page=page_number, last_page=page_number+1)
+        if dpi is None:
+            dpi = get_pdf_thumbnail_dpi(fpath_in, page_number=page_number, zoom=zoom)
+        # render to a file in temp_dir rather than keeping the bitmap in memory
+        pages = convert_from_path(fpath_in, dpi, first_page=page_number, last_page=page_number,
+                                  output_folder=temp_dir)
         page = pages[0]
         # resize
-        page = scale_and_crop_thumbnail(page, zoom=10, crop=crop)
+        page = scale_and_crop_thumbnail(page, zoom=zoom, crop=crop)
         page.save(fpath_out, 'PNG')
     except Exception as e:
         raise ThumbnailGenerationError("Fail on PDF {} {}".format(fpath_in, e))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+WAVEFORM_SAMPLE_RATE = 8000     # samples per second decoded for streamed waveforms
+WAVEFORM_BLOCK_SIZE = 32        # samples reduced to a single min/max pair while streaming
+WAVEFORM_CHUNK_SIZE = 64 * 1024 # bytes read from ffmpeg at a time
+
+def get_waveform_envelope(fpath_in, width=THUMBNAIL_SIZE[0], max_num_of_points=None):
+    """
+    Stream the audio from fpath_in as mono 16 bit PCM at `WAVEFORM_SAMPLE_RATE`
+    through an ffmpeg pipe, reducing it on the fly to the min and max of every
+    `WAVEFORM_BLOCK_SIZE` samples, so memory use doesn't grow with the raw
+    signal. If `max_num_of_points` is given only that many samples from the
+    middle of the audio are kept. Returns two arrays ``(mins, maxs)`` with the
+    envelope of the signal over (at most) `width` columns.
+    """
+    import numpy as np
+
+    ffmpeg_cmd = ['ffmpeg', '-loglevel', 'panic', '-i', fpath_in, '-vn',
+                  '-ac', '1', '-ar', str(WAVEFORM_SAMPLE_RATE),
+                  '-f', 's16le', '-acodec', 'pcm_s16le', 'pipe:1']
+    block_bytes = 2 * WAVEFORM_BLOCK_SIZE
+    block_mins, block_maxs = [], []
+    leftover = b''
+    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE)
+    try:
+        while True:
+            chunk = process.stdout.read(WAVEFORM_CHUNK_SIZE)
+            data = leftover + chunk
+            # keep partial blocks for the next chunk, unless the stream has ended
+            usable = len(data) - len(data) % block_bytes if chunk else len(data) - len(data) % 2
+            if usable:
+                samples = np.frombuffer(data[:usable], np.int16)
+                starts = np.arange(0, len(samples), WAVEFORM_BLOCK_SIZE)
+                block_mins.append(np.minimum.reduceat(samples, starts))
+                block_maxs.append(np.maximum.reduceat(samples, starts))
+            leftover = data[usable:]
+            if not chunk:
+                break
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, ffmpeg_cmd)
+    if not block_mins:
+        raise ThumbnailGenerationError("No audio found in {}".format(fpath_in))
+    mins, maxs = np.concatenate(block_mins), np.concatenate(block_maxs)
+
+    # Get blocks from middle
+    if max_num_of_points:
+        length = len(mins)
+        count = int(math.ceil(float(max_num_of_points) / WAVEFORM_BLOCK_SIZE))
+        mins = mins[max(0, (length - count) // 2):(length + count) // 2]
+        maxs = maxs[max(0, (length - count) // 2):(length + count) // 2]
+
+    return _reduce_envelope(mins, maxs, width)
+
+
+def _reduce_envelope(mins, maxs, width):
+    """
+    Reduce the `mins` and `maxs` of consecutive blocks of a signal to (at most)
+    `width` columns.
+    """
+    import numpy as np
+
+    starts = np.unique(np.linspace(0, len(mins), width, endpoint=False).astype(int))
+    return np.minimum.reduceat(mins, starts), np.maximum.reduceat(maxs, starts)
+
+
+WAVEFORM_AXES_BOX = (50, 27, 360, 200)  # matches the default matplotlib subplot margins
+_WAVEFORM_COLORMAPS = {}
+
+def _get_colormap_colors(cmap_name, vmin, vmax):
+    """
+    Return the RGB colors of the matplotlib colormap `cmap_name` truncated to
+    [vmin, vmax] as a (256, 3) uint8 array. Colormaps are looked up only once.
+    """
+    import numpy as np
+
+    key = (cmap_name, vmin, vmax)
+    if key not in _WAVEFORM_COLORMAPS:
+        cmap = _get_colormap(cmap_name)
+        colors = cmap(np.linspace(vmin, vmax, 256))[:, :3]
+        _WAVEFORM_COLORMAPS[key] = np.round(colors * 255).astype(np.uint8)
+    return _WAVEFORM_COLORMAPS[key]
+
+
+def render_waveform_image(fpath_out, mins, maxs, max_y_axis, colormap_options=None):
+    """
+    Rasterize the waveform envelope ``(mins, maxs)`` over a vertical colormap
+    gradient straight into an array and save it to fpath_out with PIL. The layout
+    matches the matplotlib renderer of `create_waveform_image`.
+    """
+    import numpy as np
+    from matplotlib.colors import to_rgb
+    from PIL import Image
+
+    colormap_options = colormap_options or {}
+    cmap_name = colormap_options.get('name') or 'cool'
+    vmin = colormap_options.get('vmin') or 0
+    vmax = colormap_options.get('vmax') or 1
+    color = colormap_options.get('color') or 'w'
+
+    left, top, right, bottom = WAVEFORM_AXES_BOX
+    width, height = right - left, bottom - top
+    image = np.full((THUMBNAIL_SIZE[1], THUMBNAIL_SIZE[0], 3), 255, dtype=np.uint8)
+
+    # Background gradient, from the colormap's start at the top to its end at the bottom,
+    # interpolated between the centers of the top and bottom halves like imshow does
+    rows = (np.arange(height) + 0.5) / height
+    positions = np.clip((rows - 0.25) * 2, 0, 1)
+    gradient = _get_colormap_colors(cmap_name, vmin, vmax)[np.round(positions * 255).astype(int)]
+    image[top:bottom, left:right] = gradient[:, np.newaxis, :]
+
+    # Envelope, stretched or squeezed to the width of the axes
+    columns = np.arange(width) * len(mins) // width
+    max_y_axis = float(max(max_y_axis, 1))
+    scale = (height - 1) / (2 * max_y_axis)
+    tops = np.round((max_y_axis - maxs[columns].astype(float)) * scale).astype(int)
+    bottoms = np.round((max_y_axis - mins[columns].astype(float)) * scale).astype(int)
+    pixel_rows = np.arange(height)[:, np.newaxis]
+    mask = (pixel_rows >= tops) & (pixel_rows <= np.maximum(tops, bottoms))
+    rgb = np.round(np.array(to_rgb(color)) * 255).astype(np.uint8)
+    image[top:bottom, left:right][mask] = rgb
+
+    Image.fromarray(image).save(fpath_out)
 
 
-def create_waveform_image(fpath_in, fpath_out, max_num_of_points=None, colormap_options=None):
+WAVEFORM_RENDERERS = ('matplotlib', 'numpy')
+
+def create_waveform_image(fpath_in, fpath_out, max_num_of_points=None, colormap_options=None,
+                          streaming=False, renderer='matplotlib'):
     """
     Create a waveform image from audio file at fpath_in and write to fpath_out.
     Colormap info: http://matplotlib.org/examples/color/colormaps_reference.html
+    With `streaming=True` the audio is piped from ffmpeg and reduced to a min/max
+    envelope (see `get_waveform_envelope`) instead of being loaded from a temporary
+    WAV file and plotted sample by sample; `max_num_of_points` then counts samples
+    at `WAVEFORM_SAMPLE_RATE`.
+    Use `renderer='numpy'` to draw the image with `render_waveform_image` instead
+    of building a matplotlib figure; it only uses matplotlib to look up colors.
     """
+    import numpy as np
+
+    if renderer not in WAVEFORM_RENDERERS:
+        raise ValueError("Unknown waveform renderer '{}', expected one of {}".format(
+            renderer, ', '.join(WAVEFORM_RENDERERS)))
+
     colormap_options = colormap_options or {}
     cmap_name = colormap_options.get('name') or 'cool'
     vmin = colormap_options.get('vmin') or 0
     vmax = colormap_options.get('vmax') or 1
     color = colormap_options.get('color') or 'w'
 
-    tempwav_fh, tempwav_name = tempfile.mkstemp(suffix=".wav")
-    os.close(tempwav_fh)  # close the file handle so ffmpeg can write to the file
+    tempwav_name = None
     try:
-        ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'panic', '-i', fpath_in]
-        # The below settings apply to the WebM encoder, which doesn't seem to be
-        # built by Homebrew on Mac, so we apply them conditionally
-        if not sys.platform.startswith('darwin'):
-            ffmpeg_cmd.extend(['-cpu-used', '-16'])
-        ffmpeg_cmd += [tempwav_name]
-        result = subprocess.check_output(ffmpeg_cmd)
-
-        spf = wave.open(tempwav_name, 'r')
-
-        # Extract raw audio from wav file
-        signal = spf.readframes(-1)
-        spf.close()
-        signal = np.frombuffer(signal, np.int16)
-
-        # Get subarray from middle
-        length = len(signal)
-        count = max_num_of_points or length
-        subsignals = signal[int((length-count)/2):int((length+count)/2)]
+        if streaming:
+            mins, maxs = get_waveform_envelope(fpath_in, max_num_of_points=max_num_of_points)
+            count = len(mins)
+            max_y_axis = max(-int(mins.min()), int(maxs.max()), 1)
+        else:
+            tempwav_fh, tempwav_name = tempfile.mkstemp(suffix=".wav")
+            os.close(tempwav_fh)  # close the file handle so ffmpeg can write to the file
+            ffmpeg_cmd = ['ffmpeg', '-y', '-loglevel', 'panic', '-i', fpath_in]
+            # The below settings apply to the WebM encoder, which doesn't seem to be
+            # built by Homebrew on Mac, so we apply them conditionally
+            if not sys.platform.startswith('darwin'):
+                ffmpeg_cmd.extend(['-cpu-used', '-16'])
+            ffmpeg_cmd += [tempwav_name]
+            result = subprocess.check_output(ffmpeg_cmd)
+
+            spf = wave.open(tempwav_name, 'r')
+
+            # Extract raw audio from wav file
+            signal = spf.readframes(-1)
+            spf.close()
+            signal = np.frombuffer(signal, np.int16)
+
+            # Get subarray from middle
+            length = len(signal)
+            count = max_num_of_points or length
+            subsignals = signal[int((length-count)/2):int((length+count)/2)]
+            max_y_axis = max(-min(subsignals), max(subsignals))
+
+        if renderer == 'numpy':
+            if not streaming:
+                mins, maxs = _reduce_envelope(subsignals, subsignals, THUMBNAIL_SIZE[0])
+            render_waveform_image(fpath_out, mins, maxs, max_y_axis, colormap_options)
+            return
+
+        from matplotlib.figure import Figure
+        from matplotlib.colors import LinearSegmentedColormap
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
 
         # Set up max and min values for axes
         X = [[.6, .6], [.7, .7]]
         xmin, xmax = xlim = 0, count
-        max_y_axis = max(-min(subsignals), max(subsignals))
         ymin, ymax = ylim = -max_y_axis, max_y_axis
 
         # Set up canvas according to user settings
@@ -184,7 +486,7 @@ def create_waveform_image(fpath_in, fpath_out, max_num_of_points=None, colormap_
         ax.set_xticklabels([])
         ax.set_xticks([])
         ax.set_yticks([])
-        cmap = plt.get_cmap(cmap_name)
+        cmap = _get_colormap(cmap_name)
         cmap = LinearSegmentedColormap.from_list(
             'trunc({n},{a:.2f},{b:.2f})'.format(n=cmap.name, a=vmin, b=vmax),
             cmap(np.linspace(vmin, vmax, 100))
@@ -192,23 +494,30 @@ def create_waveform_image(fpath_in, fpath_out, max_num_of_points=None, colormap_
         ax.imshow(X, interpolation='bicubic', cmap=cmap, extent=(xmin, xmax, ymin, ymax), alpha=1)
 
         # Plot points
-        ax.plot(np.arange(count), subsignals, color)
+        if streaming:
+            ax.fill_between(np.arange(count), mins, maxs, color=color, linewidth=0.5)
+        else:
+            ax.plot(np.arange(count), subsignals, color)
         ax.set_aspect("auto")
         canvas.print_figure(fpath_out)
     except (subprocess.CalledProcessError, Exception) as e:
         raise ThumbnailGenerationError("Failed file {} {}".format(fpath_in, e))
     finally:
-        os.remove(tempwav_name)
+        if tempwav_name:
+            os.remove(tempwav_name)
 
 
 # TILED THUMBNAILS FOR TOPIC NODES (FOLDERS)
 ################################################################################
 
-def create_tiled_image(source_images, fpath_out):
+def create_tiled_image(source_images, fpath_out, prescale=True):
     """
     Create a 16:9 tiled image from list of image paths provided in source_images
     and write result to fpath_out.
+    JPEG images are decoded at a reduced scale unless `prescale` is False.
     """
+    from PIL import Image
+
     try:
         sizes = {1:1, 4:2, 9:3, 16:4, 25:5, 36:6, 49:7}
         assert len(source_images) in sizes.keys(), "Number of images must be a perfect square <= 49"
@@ -222,7 +531,7 @@ def create_tiled_image(source_images, fpath_out):
         index = 0
         for y_index in range(root):
             for x_index in range(root):
-                im = scale_and_crop_thumbnail(images[index], size=offset)
+                im = scale_and_crop_thumbnail(images[index], size=offset, prescale=prescale)
                 new_im.paste(im, (int(offset[0]*x_index), int(offset[1]*y_index)))
                 index = index + 1
         new_im.save(fpath_out)
@@ -242,6 +551,8 @@ def convert_image(filename, dest_dir=None, size=None, format='PNG'):
 
     :returns: Path to converted file.
     """
+    from PIL import Image
+
 
     assert os.path.exists(filename), "Image file not found: {}".format(os.path.abspath(filename))
 
@@ -265,11 +576,50 @@ def convert_image(filename, dest_dir=None, size=None, format='PNG'):
     return dest_filename
 
 
-# EXCEPTIONS
+# BATCH THUMBNAIL GENERATION
 ################################################################################
 
-class ThumbnailGenerationError(Exception):
+THUMBNAIL_KINDS = ['epub', 'zip', 'pdf', 'audio', 'video']
+
+def _get_thumbnail_function(kind):
+    if kind == 'epub':
+        return create_image_from_epub
+    if kind == 'zip':
+        return create_image_from_zip
+    if kind == 'pdf':
+        return create_image_from_pdf_page
+    if kind == 'audio':
+        return create_waveform_image
+    if kind == 'video':
+        # imported here to keep importing this module light
+        from .videos import extract_thumbnail_from_video
+        return extract_thumbnail_from_video
+    raise ThumbnailGenerationError("Unsupported thumbnail kind {}".format(kind))
+
+
+def _create_thumbnail(job):
+    """
+    Run a single job for `create_thumbnails`, returning the error instead of raising it.
+    """
+    kind, fpath_in, fpath_out, options = job
+    try:
+        create = _get_thumbnail_function(kind)
+        create(fpath_in, fpath_out, **(options or {}))
+        return fpath_out
+    except ThumbnailGenerationError as e:
+        return e
+    except Exception as e:
+        return ThumbnailGenerationError("Fail on {} {} {}".format(kind, fpath_in, e))
+
+
+def create_thumbnails(jobs, max_workers=None):
     """
-    Custom error returned when thumbnail extraction process fails.
+    Generate many thumbnails in parallel in a pool of at most `max_workers`
+    processes (defaults to the number of CPUs).
+    Each job is a tuple ``(kind, fpath_in, fpath_out, options)`` where `kind` is
+    one of `THUMBNAIL_KINDS` and `options` is a dict of keyword arguments (or None)
+    for the function generating that kind of thumbnail.
+    Returns a list with, for each job in order, either its `fpath_out` or the
+    ThumbnailGenerationError that it failed with. Failed jobs don't stop the batch.
     """
-    pass
+    return run_in_process_pool(_create_thumbnail, jobs, max_workers=max_workers)
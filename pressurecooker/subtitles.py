@@ -1,10 +1,18 @@
 import codecs
+import datetime
+import io
+import mmap
+import os
+import re
 from pycaption import CaptionSet, WebVTTWriter
 from pycaption import WebVTTReader, SRTReader, SAMIReader, SCCReader, DFXPReader
 from pycaption import CaptionReadError, CaptionReadNoCaptions
 from pycaption.base import DEFAULT_LANGUAGE_CODE
+from pycaption.webvtt import TIMING_LINE_PATTERN, TIMESTAMP_PATTERN
 from le_utils.constants import file_formats
 
+from .utils import run_in_process_pool
+
 
 LANGUAGE_CODE_UNKNOWN = DEFAULT_LANGUAGE_CODE
 
@@ -71,17 +79,15 @@ class SubtitleConverter:
     """
     This class converts subtitle files to the preferred VTT format
     """
-    def __init__(self, readers, caption_str):
+    def __init__(self, readers, caption_str, writer=None):
         """
         :param readers: An array of `SubtitleReader` instances
         :param caption_str: A string with the captions content
+        :param writer: A `WebVTTWriter` to write the captions with, otherwise one is built
         """
         self.readers = readers
         self.caption_str = caption_str
-        self.writer = WebVTTWriter()
-        # set "video size" to 100 since other types may have layout, 100 should work to generate %
-        self.writer.video_width = 100
-        self.writer.video_height = self.writer.video_width * 6 / 19
+        self.writer = writer or build_vtt_writer()
         self.caption_set = None
 
     def get_caption_set(self):
@@ -164,18 +170,45 @@ class SubtitleConverter:
         :rtype: str
         """
         caption_set = self.get_caption_set()
+        return self._convert(caption_set, lang_code, dict(caption_set.get_styles()))
+
+    def _convert(self, caption_set, lang_code, styles):
         captions = caption_set.get_captions(lang_code)
 
         if not captions:
             raise InvalidSubtitleLanguageError(
                 "Language '{}' is not present in caption set".format(lang_code))
 
-        styles = caption_set.get_styles()
         layout_info = caption_set.get_layout_info(lang_code)
         lang_caption_set = CaptionSet(
-            {lang_code: captions}, styles=dict(styles), layout_info=layout_info)
+            {lang_code: captions}, styles=styles, layout_info=layout_info)
         return self.writer.write(lang_caption_set)
 
+    def write_all(self, out_dir_or_template):
+        """
+        Convenience method to write the captions of every language as VTT files, reading the
+        captions and copying their styles only once for all the languages.
+
+        :param out_dir_or_template: A string path to a directory to put `<lang_code>.vtt` files in,
+                                    or a string path template with a `{lang_code}` placeholder
+        :return: A dict with the path written for each language code
+        """
+        if '{lang_code}' in out_dir_or_template:
+            template = out_dir_or_template
+        else:
+            template = os.path.join(out_dir_or_template, '{lang_code}.vtt')
+
+        caption_set = self.get_caption_set()
+        # the writer copies the caption set it writes, so the styles can be shared
+        styles = dict(caption_set.get_styles())
+        out_filenames = {}
+        for lang_code in caption_set.get_languages():
+            out_filename = template.format(lang_code=lang_code)
+            with codecs.open(out_filename, 'w', encoding='utf-8') as converted_file:
+                converted_file.write(self._convert(caption_set, lang_code, styles))
+            out_filenames[lang_code] = out_filename
+        return out_filenames
+
 
 #####################
 # FACTORY FUNCTIONS #
@@ -201,6 +234,14 @@ def build_vtt_reader():
     return SubtitleReader(WebVTTReader(), requires_language=True)
 
 
+def build_vtt_writer():
+    writer = WebVTTWriter()
+    # set "video size" to 100 since other types may have layout, 100 should work to generate %
+    writer.video_width = 100
+    writer.video_height = writer.video_width * 6 / 19
+    return writer
+
+
 BUILD_READER_MAP = {
     file_formats.VTT: build_vtt_reader,
     file_formats.SRT: build_srt_reader,
@@ -211,40 +252,192 @@ BUILD_READER_MAP = {
 }
 
 
-def build_subtitle_reader(reader_format):
+# Formats in the order readers are tried when the format isn't known, most likely first.
+# TTML and DFXP share the same reader so only DFXP is listed.
+READER_FORMATS_BY_LIKELIHOOD = [
+    file_formats.VTT,
+    file_formats.SRT,
+    file_formats.DFXP,
+    file_formats.SAMI,
+    file_formats.SCC,
+]
+
+SNIFF_LENGTH = 512  # number of leading characters looked at by `sniff_subtitle_format`
+SRT_START_RE = re.compile(r'^\d+[ \t]*\r?\n\d+:\d{2}:\d{2}[,.]\d{3}[ \t]*-->')
+TT_TAG_RE = re.compile(r'<(\w+:)?tt[\s>]')
+
+
+def sniff_subtitle_format(caption_str):
+    """
+    Guesses the format of captions from the first `SNIFF_LENGTH` characters, without parsing them
+
+    :param caption_str: A string with the captions contents
+    :type: captions_str: str
+    :return: The format of the captions, or `None` if it couldn't be guessed
+    :rtype: str, None
+    """
+    head = caption_str[:SNIFF_LENGTH].lstrip(u'\ufeff \t\r\n')
+    if head.startswith('WEBVTT'):
+        return file_formats.VTT
+    if head.startswith('Scenarist_SCC'):
+        return file_formats.SCC
+    if SRT_START_RE.match(head):
+        return file_formats.SRT
+    if '<sami' in head.lower():
+        return file_formats.SAMI
+    if TT_TAG_RE.search(head):
+        return file_formats.DFXP
+    return None
+
+
+
+# Byte order marks, longest first since the UTF-32 LE mark starts with the UTF-16 LE one
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+ENCODING_SAMPLE_LENGTH = 64 * 1024  # number of leading bytes looked at by `detect_subtitle_encoding`
+FALLBACK_ENCODINGS = ['cp1252', 'latin-1']  # tried in order when the bytes aren't UTF-8 or UTF-16
+
+
+def detect_subtitle_encoding(caption_bytes):
+    """
+    Guesses the encoding of captions from their byte order mark or, without one, from the first
+    `ENCODING_SAMPLE_LENGTH` bytes: UTF-16 if they have null bytes, UTF-8 if they decode as such,
+    otherwise the first of `FALLBACK_ENCODINGS` that decodes them.
+
+    :param caption_bytes: The bytes of the captions, e.g. a `bytes` or `mmap.mmap` object
+    :return: The name of the encoding to decode `caption_bytes` with
+    :rtype: str
+    """
+    sample = caption_bytes[:ENCODING_SAMPLE_LENGTH]
+    for bom, encoding in BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding
+
+    # text encoded in UTF-8 or a single-byte encoding has no null bytes, UTF-16 has them in
+    # the high byte of ASCII characters (and is often also valid UTF-8)
+    even_nulls = sample[0::2].count(b'\x00')
+    odd_nulls = sample[1::2].count(b'\x00')
+    if even_nulls or odd_nulls:
+        return 'utf-16-le' if odd_nulls > even_nulls else 'utf-16-be'
+
+    try:
+        # a multi-byte character may be cut at the end of the sample
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=len(sample) < ENCODING_SAMPLE_LENGTH)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+
+    for encoding in FALLBACK_ENCODINGS:
+        try:
+            sample.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return FALLBACK_ENCODINGS[-1]
+
+
+def decode_subtitle_bytes(caption_bytes, encoding=None):
+    """
+    Decodes the bytes of captions in a single pass, with `encoding` or the encoding guessed by
+    `detect_subtitle_encoding`. Characters that don't decode in a guessed encoding are replaced.
+
+    :param caption_bytes: The bytes of the captions, e.g. a `bytes` or `mmap.mmap` object
+    :param encoding: A string with the encoding of the captions, otherwise detected
+    :type: encoding: str
+    :return: A string with the captions contents
+    :rtype: str
+    """
+    if encoding is not None:
+        errors = 'strict'
+    else:
+        encoding = detect_subtitle_encoding(caption_bytes)
+        errors = 'replace'
+    try:
+        return codecs.decode(caption_bytes, encoding, errors)
+    except UnicodeDecodeError as e:
+        raise InvalidSubtitleFormatError('Caption file is not {}: {}'.format(encoding, e))
+
+# The pycaption readers and writer only keep state while reading or writing a single file, so
+# one instance of each can be reused by every conversion in a process. SCCReader is the exception:
+# it keeps the captions it read, so it's always built anew.
+SHAREABLE_READER_BUILDERS = [build_vtt_reader, build_srt_reader, build_sami_reader, build_dfxp_reader]
+_shared_readers = {}
+_shared_writer = []
+
+
+def build_subtitle_reader(reader_format, shared=False):
     if reader_format not in BUILD_READER_MAP:
         raise InvalidSubtitleFormatError('Unsupported')
-    return BUILD_READER_MAP[reader_format]()
+    build = BUILD_READER_MAP[reader_format]
+    if not shared or build not in SHAREABLE_READER_BUILDERS:
+        return build()
+    if build not in _shared_readers:
+        _shared_readers[build] = build()
+    return _shared_readers[build]
 
 
-def build_subtitle_readers():
-    readers = []
-    for reader_format, build in BUILD_READER_MAP.items():
-        readers.append(build())
-    return readers
+def build_subtitle_readers(first_format=None, shared=False):
+    """
+    Builds a reader for every supported format, ordered by how likely the format is
+
+    :param first_format: A string with the format of the reader to put first, if any
+    :type: first_format: str
+    :param shared: Whether to reuse the reader instances shared in this process (not thread-safe)
+    :type: shared: bool
+    :return: An array of `SubtitleReader` instances
+    """
+    formats = list(READER_FORMATS_BY_LIKELIHOOD)
+    if first_format in BUILD_READER_MAP:
+        first_build = BUILD_READER_MAP[first_format]
+        formats = [first_format] + [f for f in formats if BUILD_READER_MAP[f] is not first_build]
+    return [build_subtitle_reader(reader_format, shared=shared) for reader_format in formats]
+
+
+def get_shared_vtt_writer():
+    """
+    :return: The `WebVTTWriter` shared in this process (not thread-safe)
+    """
+    if not _shared_writer:
+        _shared_writer.append(build_vtt_writer())
+    return _shared_writer[0]
 
 
-def build_subtitle_converter(caption_str, in_format=None):
+def build_subtitle_converter(caption_str, in_format=None, shared=False, encoding=None):
     """
     Builds a subtitle converter used to convert subtitle files to VTT format
 
-    :param caption_str: A string with the captions contents
-    :type: captions_str: str
-    :param in_format: A string with expected format of the file to be converted
+    :param caption_str: A string with the captions contents, or their bytes (e.g. a `bytes` or
+                        `mmap.mmap` object) to decode with `decode_subtitle_bytes`
+    :type: captions_str: str, bytes
+    :param in_format: A string with expected format of the file to be converted, otherwise
+                      guessed with `sniff_subtitle_format`
     :type: in_format: str
+    :param shared: Whether to reuse the reader and writer instances shared in this process
+                   instead of building new ones (not thread-safe)
+    :type: shared: bool
+    :param encoding: A string with the encoding of bytes captions, otherwise detected
+    :type: encoding: str
     :return: A SubtitleConverter
     :rtype: SubtitleConverter
     """
+    if not isinstance(caption_str, type(u'')):
+        caption_str = decode_subtitle_bytes(caption_str, encoding)
+
     readers = []
     if in_format is not None:
-        readers.append(build_subtitle_reader(in_format))
+        readers.append(build_subtitle_reader(in_format, shared=shared))
     else:
-        readers = build_subtitle_readers()
+        readers = build_subtitle_readers(first_format=sniff_subtitle_format(caption_str), shared=shared)
 
-    return SubtitleConverter(readers, caption_str)
+    return SubtitleConverter(readers, caption_str, writer=get_shared_vtt_writer() if shared else None)
 
 
-def build_subtitle_converter_from_file(captions_filename, in_format=None):
+def build_subtitle_converter_from_file(captions_filename, in_format=None, shared=False, encoding=None):
     """
     Reads `captions_filename` as the file to be converted, and returns a `SubtitleConverter`
     instance that can be used to do the conversion.
@@ -253,12 +446,226 @@ def build_subtitle_converter_from_file(captions_filename, in_format=None):
     :type: captions_filename: str
     :param in_format: A string with expected format of `captions_filename`, otherwise detected
     :type: in_format: str
+    :param shared: Whether to reuse the reader and writer instances shared in this process
+    :type: shared: bool
+    :param encoding: A string with the encoding of `captions_filename`, otherwise detected
+    :type: encoding: str
     :return: A SubtitleConverter
     :rtype: SubtitleConverter
     """
-    with codecs.open(captions_filename, encoding='utf-8') as captions_file:
-        captions_str = captions_file.read()
+    with open(captions_filename, 'rb') as captions_file:
+        if os.fstat(captions_file.fileno()).st_size == 0:
+            captions_str = decode_subtitle_bytes(b'', encoding)   # empty files can't be mapped
+        else:
+            # decode straight from the mapped file instead of reading it into bytes first
+            captions_map = mmap.mmap(captions_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                captions_str = decode_subtitle_bytes(captions_map, encoding)
+            finally:
+                captions_map.close()
+
+    return build_subtitle_converter(captions_str, in_format, shared=shared)
+
+
+########################
+# STREAMING CONVERSION #
+########################
+
+SRT_TIMING_RE = re.compile(r'^ *(\d+):(\d+):(\d+),(\d+) *--> *(\d+):(\d+):(\d+),(\d+) *$')
+# text needing pycaption: SRT/VTT tags, VTT entities and SRT {\an8}-style positioning
+STYLED_TEXT_RE = re.compile(r'[<&]|\{\\')
+
+
+class _StreamingUnsupported(Exception):
+    """
+    Raised when the captions need the pycaption readers to be converted
+    """
+    pass
+
+
+def _vtt_timestamp(microseconds):
+    # same as WebVTTWriter._timestamp
+    td = datetime.timedelta(microseconds=microseconds)
+    mm, ss = divmod(td.seconds, 60)
+    hh, mm = divmod(mm, 60)
+    timestamp = '%02d:%02d.%03d' % (mm, ss, td.microseconds // 1000)
+    if hh:
+        timestamp = '%d:%s' % (hh, timestamp)
+    return timestamp
+
+
+def _vtt_cue(start, end, lines):
+    # same as WebVTTWriter._write_caption for unstyled text at the default position
+    text = u'\n'.join(line.replace('-->', '--&gt;') or u'&nbsp;' for line in lines)
+    return u'{} --> {}\n{}\n'.format(_vtt_timestamp(start), _vtt_timestamp(end), text)
+
+
+def _iter_lines(captions_file):
+    # same lines as `str.splitlines` on the whole contents
+    for line in captions_file:
+        for split_line in line.splitlines():
+            yield split_line
+
+
+def _iter_srt_cues(lines):
+    """
+    Yields the `(start, end, lines)` of the SRT cues like `SRTReader` reads them
+    """
+    def parse_timing(line):
+        match = SRT_TIMING_RE.match(line)
+        if not match:
+            raise _StreamingUnsupported()
+        h1, m1, s1, f1, h2, m2, s2, f2 = [int(value) for value in match.groups()]
+        return (((h1 * 60 + m1) * 60 + s1) * 1000 + f1) * 1000, (((h2 * 60 + m2) * 60 + s2) * 1000 + f2) * 1000
+
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None and line.isdigit():
+        start, end = parse_timing(next(lines, u''))
+        cue_lines = []
+        blank_lines = []
+        for line in lines:
+            if line.strip() == u'':
+                blank_lines.append(line)
+            elif blank_lines:
+                break   # the index of the next cue
+            elif STYLED_TEXT_RE.search(line):
+                raise _StreamingUnsupported()
+            else:
+                cue_lines.append(line)
+        else:
+            line = None
+            blank_lines.append(None)    # all blank lines are kept at the end of the file
+        # SRTReader keeps the blank lines but the last one, skipping empty ones after text
+        for blank_line in blank_lines[:-1]:
+            if not cue_lines or blank_line != u'':
+                cue_lines.append(blank_line)
+        if cue_lines:
+            yield start, end, cue_lines
+
+
+def _iter_vtt_cues(lines):
+    """
+    Yields the `(start, end, lines)` of the VTT cues like `WebVTTReader` reads them
+    """
+    def parse_timestamp(timestamp):
+        match = TIMESTAMP_PATTERN.search(timestamp)
+        if not match:
+            raise _StreamingUnsupported()
+        hours, minutes, seconds, milliseconds = match.groups()
+        if not seconds:
+            hours, minutes, seconds = 0, hours, minutes
+        return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds.lstrip(':'))) * 1000000 + int(milliseconds) * 1000
+
+    start = end = None
+    cue_lines = []
+    found_timing = False
+    for line in lines:
+        if '-->' in line:
+            match = TIMING_LINE_PATTERN.search(line)
+            if not match or match.group(3):
+                raise _StreamingUnsupported()   # invalid or positioned cue
+            start, end = parse_timestamp(match.group(1)), parse_timestamp(match.group(2))
+            found_timing = True
+        elif line == u'':
+            if found_timing:
+                if cue_lines:
+                    yield start, end, cue_lines
+                found_timing = False
+                cue_lines = []
+        elif found_timing:
+            if STYLED_TEXT_RE.search(line):
+                raise _StreamingUnsupported()
+            cue_lines.append(line.strip())
+    if cue_lines:
+        yield start, end, cue_lines
+
+
+def stream_subtitle_file(captions_filename, out_filename, in_format=None, encoding=None):
+    """
+    Converts an SRT or VTT file to VTT line by line, with the same output as `SubtitleConverter`
+    but without loading the whole file or building pycaption captions. Files in other formats,
+    with styled or positioned cues, or that can't be read are left to `SubtitleConverter`.
+
+    :param captions_filename: A string path to the captions file to convert
+    :param out_filename: A string path to put the converted captions contents
+    :param in_format: A string with expected format of `captions_filename`, otherwise detected
+    :param encoding: A string with the encoding of `captions_filename`, otherwise detected from
+                     its first bytes like in `decode_subtitle_bytes`
+    :return: True if the file was converted, False if it needs `SubtitleConverter`
+    :rtype: bool
+    """
+    errors = 'strict'
+    if encoding is None:
+        with open(captions_filename, 'rb') as captions_file:
+            encoding = detect_subtitle_encoding(captions_file.read(ENCODING_SAMPLE_LENGTH))
+        errors = 'replace'
+
+    with io.open(captions_filename, encoding=encoding, errors=errors, newline='') as captions_file:
+        if in_format is None:
+            try:
+                in_format = sniff_subtitle_format(captions_file.read(SNIFF_LENGTH))
+            except UnicodeDecodeError:
+                return False
+            captions_file.seek(0)
+        if in_format == file_formats.SRT:
+            cues = _iter_srt_cues(_iter_lines(captions_file))
+        elif in_format == file_formats.VTT:
+            cues = _iter_vtt_cues(_iter_lines(captions_file))
+        else:
+            return False
 
-    return build_subtitle_converter(captions_str, in_format)
+        written = False
+        try:
+            with io.open(out_filename, 'w', encoding='utf-8', newline='') as converted_file:
+                converted_file.write(WebVTTWriter.HEADER)
+                for start, end, lines in cues:
+                    if written:
+                        converted_file.write(u'\n')
+                    converted_file.write(_vtt_cue(start, end, lines))
+                    written = True
+        except (_StreamingUnsupported, UnicodeDecodeError):
+            written = False
+        if not written:
+            # let SubtitleConverter convert or reject the file
+            os.remove(out_filename)
+        return written
+
+
+#####################
+# BATCH CONVERSION  #
+#####################
+
+def _convert_subtitle_file(job):
+    """
+    Runs a single job for `convert_subtitle_files`, returning the error instead of raising it.
+    """
+    captions_filename, out_filename, lang_code = job
+    try:
+        if stream_subtitle_file(captions_filename, out_filename):
+            return out_filename
+        converter = build_subtitle_converter_from_file(captions_filename, shared=True)
+        if not converter.has_language(lang_code) and converter.has_language(LANGUAGE_CODE_UNKNOWN):
+            converter.replace_unknown_language(lang_code)
+        converter.write(out_filename, lang_code)
+        return out_filename
+    except (InvalidSubtitleFormatError, InvalidSubtitleLanguageError) as e:
+        return e
+    except Exception as e:
+        return InvalidSubtitleFormatError('Fail on {}: {}'.format(captions_filename, e))
+
+
+def convert_subtitle_files(jobs, max_workers=None):
+    """
+    Converts many subtitle files to VTT in parallel in a pool of at most `max_workers`
+    processes (defaults to the number of CPUs), reusing the readers and writer in each process.
+
+    :param jobs: An iterable of `(captions_filename, out_filename, lang_code)` tuples. Captions
+                 with an unknown language (e.g. SRT files) are written as `lang_code`
+    :param max_workers: The maximum number of worker processes
+    :return: A list with, for each job in order, either its `out_filename` or the
+             `InvalidSubtitleFormatError`/`InvalidSubtitleLanguageError` it failed with
+    """
+    return run_in_process_pool(_convert_subtitle_file, jobs, max_workers=max_workers)
 
 
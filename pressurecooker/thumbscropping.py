@@ -1,5 +1,7 @@
+import itertools
 import math
 import re
+import numpy as np
 from PIL import Image
 import sys
 import types
@@ -53,21 +55,145 @@ def image_entropy(im):
     if not isinstance(im, Image.Image):
         # Can only deal with PIL images. Fall back to a constant entropy.
         return 0
-    hist = im.histogram()
-    hist_size = float(sum(hist))
-    hist = [h / hist_size for h in hist]
-    return -sum([p * math.log(p, 2) for p in hist if p != 0])
+    return float(_histogram_entropy(im.histogram()))
 
 
+def _histogram_entropy(hist):
+    """
+    Calculate the entropy of a histogram, or of a stack of histograms when
+    ``hist`` has more than one dimension (bins are on the last axis).
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    hist_size = hist.sum(axis=-1, keepdims=True)
+    p = hist / np.maximum(hist_size, 1)
+    logp = np.log2(np.where(p > 0, p, 1))
+    return -(p * logp).sum(axis=-1)
+
+
+class SliceEntropy(object):
+    """
+    Calculate the entropy of full-height column slices and full-width row
+    slices of an image from PIL's histogram of the cropped slice, which is
+    cheaper than converting the whole image to an array for the handful of
+    slices the greedy "smart" crop looks at.
+    """
+
+    def __init__(self, im):
+        self.im = im
+
+    def columns(self, start, end):
+        """
+        Entropy of the columns ``start`` (inclusive) to ``end`` (exclusive).
+        """
+        return image_entropy(self.im.crop((start, 0, end, self.im.size[1])))
+
+    def rows(self, start, end):
+        """
+        Entropy of the rows ``start`` (inclusive) to ``end`` (exclusive).
+        """
+        return image_entropy(self.im.crop((0, start, self.im.size[0], end)))
+
+    def best_columns(self, length):
+        """
+        Return the start of the ``length`` columns wide window with the most
+        entropy.
+        """
+        return _best_window(self.im, 0, length)
+
+    def best_rows(self, length):
+        """
+        Return the start of the ``length`` rows tall window with the most
+        entropy.
+        """
+        return _best_window(self.im, 1, length)
+
+
+def _slice_histograms(im, axis, bounds):
+    """
+    Return the histograms of the slices of ``im`` between consecutive
+    ``bounds`` along ``axis`` (0 for columns, 1 for rows) as an array with
+    one row per slice.
+    """
+    width, height = im.size
+    histograms = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        box = (start, 0, end, height) if axis == 0 else (0, start, width, end)
+        histograms.append(im.crop(box).histogram())
+    # much quicker than np.array for a list of lists
+    bins = len(histograms[0])
+    return np.fromiter(itertools.chain.from_iterable(histograms), dtype=np.int64,
+                       count=len(histograms) * bins).reshape(len(histograms), bins)
+
+
+def _best_window(im, axis, length, samples=32, refine_factor=4):
+    """
+    Sweep a ``length`` wide window over ``axis`` of ``im`` and return the
+    start of the window with the most entropy. The axis is cut into about
+    ``samples`` blocks whose histograms are summed to sweep the window a block
+    at a time, from a sample of at most ``samples`` lines across the axis.
+    The window is then refined around the best start with blocks
+    ``refine_factor`` times smaller, down to single slices of the full image.
+    """
+    size = im.size[axis]
+    count = size - length + 1
+    if count <= 1:
+        return 0
+    stride = max(1, size // samples)
+    bounds = list(range(0, size, stride)) + [size]
+    # the blocks only pick where to refine, so they are measured on at most
+    # `samples` evenly spaced lines across the axis
+    sample_size = list(im.size)
+    sample_size[1 - axis] = min(sample_size[1 - axis], samples)
+    sample = im.resize(tuple(sample_size), resample=Image.NEAREST)
+    block_histograms = _slice_histograms(sample, axis, bounds)
+    cumulative = np.cumsum(np.vstack([
+        np.zeros_like(block_histograms[:1]),
+        block_histograms,
+    ]), axis=0)
+    blocks = max(1, int(round(length / float(stride))))
+    starts = np.arange(0, len(bounds) - blocks)
+    hist = cumulative[starts + blocks] - cumulative[starts]
+    best = min(int(_best_start(hist, starts * stride, count)), count - 1)
+
+    while stride > 1:
+        # exact windows from the one at `low`, adding and removing blocks
+        step = max(1, stride // refine_factor)
+        low, high = max(0, best - stride), min(count - 1, best + stride)
+        starts = np.arange(low, high + 1, step)
+        stride = step
+        if len(starts) == 1:
+            continue
+        first = _slice_histograms(im, axis, [low, low + length])
+        removed = _slice_histograms(im, axis, list(starts))
+        added = _slice_histograms(im, axis, list(starts + length))
+        hist = first + np.vstack([
+            np.zeros_like(first),
+            np.cumsum(added - removed, axis=0),
+        ])
+        best = int(_best_start(hist, starts, count))
+    return best
+
+
+def _best_start(hist, starts, count):
+    """
+    Return the entry of ``starts`` whose window histogram in ``hist`` has the
+    most entropy. Windows within rounding error of the best one are resolved
+    in favour of the one closest to the center, which is where the image
+    would be cropped without entropy.
+    """
+    entropies = _histogram_entropy(hist)
+    candidates = starts[entropies >= entropies.max() - 1e-9]
+    center = (count - 1) / 2.0
+    return candidates[np.argmin(np.abs(candidates - center))]
 
-def _compare_entropy(start_slice, end_slice, slice, difference):
+
+
+def _compare_entropy(start_entropy, end_entropy, slice, difference):
     """
-    Calculate the entropy of two slices (from the start and end of an axis),
+    Compare the entropy of two slices (from the start and end of an axis),
     returning a tuple containing the amount that should be added to the start
     and removed from the end of the axis.
     """
-    start_entropy = image_entropy(start_slice)
-    end_entropy = image_entropy(end_slice)
     if end_entropy and abs(start_entropy / end_entropy - 1) < 0.01:
         # Less than 1% difference, remove from both sides.
         if difference >= slice * 2:
@@ -81,7 +207,75 @@ def _compare_entropy(start_slice, end_slice, slice, difference):
 
 
 
-def scale_and_crop(im, size, crop=False, upscale=False, zoom=None, target=None, **kwargs):
+def _smart_crop_box(entropy, diff_x, diff_y):
+    """
+    Find the "smart" crop box by incrementally removing slices from the edges
+    with the least entropy until ``diff_x`` columns and ``diff_y`` rows have
+    been removed.
+    """
+    source_x, source_y = entropy.im.size
+    left = top = 0
+    right, bottom = source_x, source_y
+    while diff_x:
+        slice = min(diff_x, max(diff_x // 5, 10))
+        start = entropy.columns(left, left + slice)
+        end = entropy.columns(right - slice, right)
+        add, remove = _compare_entropy(start, end, slice, diff_x)
+        left += add
+        right -= remove
+        diff_x = diff_x - add - remove
+    while diff_y:
+        slice = min(diff_y, max(diff_y // 5, 10))
+        start = entropy.rows(top, top + slice)
+        end = entropy.rows(bottom - slice, bottom)
+        add, remove = _compare_entropy(start, end, slice, diff_y)
+        top += add
+        bottom -= remove
+        diff_y = diff_y - add - remove
+    return (left, top, right, bottom)
+
+
+def _smart_fast_crop_box(entropy, diff_x, diff_y):
+    """
+    Find the "smart-fast" crop box by keeping the full-height and full-width
+    windows with the most entropy after removing ``diff_x`` columns and
+    ``diff_y`` rows.
+    """
+    source_x, source_y = entropy.im.size
+    width, height = source_x - diff_x, source_y - diff_y
+    left = entropy.best_columns(width)
+    top = entropy.best_rows(height)
+    return (left, top, left + width, top + height)
+
+
+
+def prescale_image(im, size, crop=False, zoom=None):
+    """
+    Ask the JPEG decoder to decode ``im`` at the smallest power-of-two scale
+    (1/2, 1/4 or 1/8) that is still larger than the size ``scale_and_crop``
+    will scale it to, so the final high quality resize starts from a much
+    smaller image. Other formats, or images that have already been loaded,
+    are returned unchanged.
+    """
+    if im.format != 'JPEG':
+        return im
+    source_x, source_y = [float(v) for v in im.size]
+    target_x, target_y = [int(v) for v in size]
+    if crop or not target_x or not target_y:
+        scale = max(target_x / source_x, target_y / source_y)
+    else:
+        scale = min(target_x / source_x, target_y / source_y)
+    if zoom:
+        scale *= (100 + int(zoom)) / 100.0
+    if scale < 1.0:
+        im.draft(im.mode, (int(math.ceil(source_x * scale)),
+                           int(math.ceil(source_y * scale))))
+    return im
+
+
+
+def scale_and_crop(im, size, crop=False, upscale=False, zoom=None, target=None,
+                   prescale=False, **kwargs):
     """
     Handle scaling and cropping the source image.
     Images can be scaled / cropped against a single dimension by using zero
@@ -104,6 +298,11 @@ def scale_and_crop(im, size, crop=False, upscale=False, zoom=None, target=None,
         The image can also be "smart cropped" by using ``crop="smart"``. The
         image is incrementally cropped down to the requested size by removing
         slices from edges with the least entropy.
+        Use ``crop="smart-fast"`` to instead sweep a window of the requested
+        size over each axis, coarsely then finely around the best position,
+        and keep the one with the most entropy. On very wide or tall images
+        this is quicker than ``"smart"`` and keeps a window closer to the one
+        with the most entropy.
         Finally, you can use ``crop="scale"`` to simply scale the image so that
         at least one dimension fits within the size dimensions given (you may
         want to use the upscale option too).
@@ -123,7 +322,13 @@ def scale_and_crop(im, size, crop=False, upscale=False, zoom=None, target=None,
         Can either be set as a two-item tuple such as ``(20, 30)`` or a comma
         separated string such as ``"20,10"``.
         A null value such as ``(20, None)`` or ``",60"`` will default to 50%.
+    prescale
+        Decode JPEG images at a reduced scale before resizing them (see
+        ``prescale_image``). Only has an effect if the image data has not been
+        loaded yet, i.e. right after ``Image.open``.
     """
+    if prescale:
+        im = prescale_image(im, size, crop=crop, zoom=zoom)
     source_x, source_y = [float(v) for v in im.size]
     target_x, target_y = [int(v) for v in size]
 
@@ -199,26 +404,12 @@ def scale_and_crop(im, size, crop=False, upscale=False, zoom=None, target=None,
                         box[1] = offset
                         box[3] = source_y - (diff_y - offset)
             # See if the image should be "smart cropped".
-            elif crop == 'smart':
-                left = top = 0
-                right, bottom = source_x, source_y
-                while diff_x:
-                    slice = min(diff_x, max(diff_x // 5, 10))
-                    start = im.crop((left, 0, left + slice, source_y))
-                    end = im.crop((right - slice, 0, right, source_y))
-                    add, remove = _compare_entropy(start, end, slice, diff_x)
-                    left += add
-                    right -= remove
-                    diff_x = diff_x - add - remove
-                while diff_y:
-                    slice = min(diff_y, max(diff_y // 5, 10))
-                    start = im.crop((0, top, source_x, top + slice))
-                    end = im.crop((0, bottom - slice, source_x, bottom))
-                    add, remove = _compare_entropy(start, end, slice, diff_y)
-                    top += add
-                    bottom -= remove
-                    diff_y = diff_y - add - remove
-                box = (left, top, right, bottom)
+            elif crop in ('smart', 'smart-fast'):
+                entropy = SliceEntropy(im)
+                if crop == 'smart-fast':
+                    box = _smart_fast_crop_box(entropy, diff_x, diff_y)
+                else:
+                    box = _smart_crop_box(entropy, diff_x, diff_y)
             # Finally, crop the image!
             im = im.crop(box)
     return im
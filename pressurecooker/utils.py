@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 
 
@@ -15,6 +16,39 @@ def make_dir_if_needed(path):
     return path
 
 
+def run_in_process_pool(func, items, max_workers=None):
+    """
+    Call `func` on each of `items` across a pool of worker processes and return
+    the results in the same order as `items`. At most `max_workers` processes are
+    used (defaults to the number of CPUs) and no more than twice that many items
+    are queued at once. With `max_workers=1` everything runs in this process.
+
+    :param func: A picklable (module-level) function taking a single item
+    :param items: An iterable of picklable items
+    :param max_workers: The maximum number of worker processes
+    :return: A list with the return value of `func` for each item
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+    items = list(items)
+    max_workers = min(max_workers or multiprocessing.cpu_count(), max(len(items), 1))
+    if max_workers == 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    pending = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for index, item in enumerate(items):
+            if len(pending) >= 2 * max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+            pending[executor.submit(func, item)] = index
+        for future, index in pending.items():
+            results[index] = future.result()
+    return results
+
+
 class VideoURLFormatError(Exception):
     def __init__(self, url, expected_format):
         self.message = "The video at {} does not appear to be a proper {} video URL.".format(url, expected_format)
\ No newline at end of file
@@ -1,14 +1,138 @@
-import re
-import subprocess
+import heapq
+import json
 import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 
 from le_utils.constants import format_presets
 
-from .images import ThumbnailGenerationError
+from .exceptions import ThumbnailGenerationError, VideoCompressionError
+from .utils import run_in_process_pool
 
 LOGGER = logging.getLogger("VideoResource")
 LOGGER.setLevel(logging.DEBUG)
 
+
+
+# MEDIA PROBING
+################################################################################
+
+PROBE_CACHE_SIZE = 1024     # number of probe results memoized by `probe_media`
+_PROBE_CACHE = OrderedDict()
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class MediaInfo(object):
+    """
+    The streams and container information of a media file, as reported by `ffprobe`.
+    The raw `ffprobe` output is kept in `streams` and `format`; the attributes below
+    describe the first video stream (cover art excluded) and the first audio stream.
+    """
+    def __init__(self, data):
+        self.streams = data.get('streams', [])
+        self.format = data.get('format', {})
+        self.video_stream = None
+        self.audio_stream = None
+        for stream in self.streams:
+            if stream.get('disposition', {}).get('attached_pic'):
+                continue
+            if stream.get('codec_type') == 'video' and self.video_stream is None:
+                self.video_stream = stream
+            elif stream.get('codec_type') == 'audio' and self.audio_stream is None:
+                self.audio_stream = stream
+        video = self.video_stream or {}
+        audio = self.audio_stream or {}
+
+        self.format_name = self.format.get('format_name')
+        self.duration = _to_float(self.format.get('duration')) or _to_float(video.get('duration')) \
+            or _to_float(audio.get('duration'))
+        self.bit_rate = _to_int(self.format.get('bit_rate'))
+
+        self.video_codec = video.get('codec_name')
+        self.video_profile = video.get('profile')
+        self.video_bit_rate = _to_int(video.get('bit_rate'))
+        self.width = _to_int(video.get('width'))
+        self.height = _to_int(video.get('height'))
+        self.rotation = self._get_rotation(video)
+
+        self.audio_codec = audio.get('codec_name')
+        self.audio_bit_rate = _to_int(audio.get('bit_rate'))
+        self.sample_rate = _to_int(audio.get('sample_rate'))
+        self.channels = _to_int(audio.get('channels'))
+
+    @staticmethod
+    def _get_rotation(stream):
+        rotate = _to_int(stream.get('tags', {}).get('rotate'))
+        if rotate is not None:
+            return rotate % 360
+        for side_data in stream.get('side_data_list', []):
+            rotation = _to_float(side_data.get('rotation'))
+            if rotation is not None:
+                # the display matrix rotation is counterclockwise
+                return int(round(-rotation)) % 360
+        return 0
+
+    @property
+    def resolution(self):
+        """
+        The ``(width, height)`` of the video stream, or None for files without video.
+        """
+        if self.width is None or self.height is None:
+            return None
+        return self.width, self.height
+
+
+def probe_media(path):
+    """
+    Run `ffprobe` once on the media file at `path` and return a `MediaInfo`.
+    Results are memoized by the path, size and modification time of the file,
+    so probing the same file repeatedly only runs `ffprobe` once.
+    Raises `subprocess.CalledProcessError` if `ffprobe` fails.
+    """
+    path = str(path)
+    try:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    except OSError:
+        key = None  # let ffprobe report the error
+
+    if key is not None and key in _PROBE_CACHE:
+        _PROBE_CACHE[key] = info = _PROBE_CACHE.pop(key)  # mark as recently used
+        return info
+
+    result = subprocess.check_output(['ffprobe', '-v', 'error', '-print_format', 'json',
+                                      '-show_format', '-show_streams', path])
+    info = MediaInfo(json.loads(result.decode('utf-8')))
+    if key is not None:
+        _PROBE_CACHE[key] = info
+        while len(_PROBE_CACHE) > PROBE_CACHE_SIZE:
+            _PROBE_CACHE.popitem(last=False)
+    return info
+
+
+
+# VIDEO FUNCTIONS
+################################################################################
+
 def guess_video_preset_by_resolution(videopath):
     """
     Run `ffprobe` to find resolution classify as high resolution (video height >= 720),
@@ -17,15 +141,11 @@ def guess_video_preset_by_resolution(videopath):
     """
     try:
         LOGGER.debug("Entering 'guess_video_preset_by_resolution' method")
-        result = subprocess.check_output(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_entries',
-                                          'stream=width,height', '-of', 'default=noprint_wrappers=1', str(videopath)])
-        LOGGER.debug("ffprobe stream result = {}".format(result))
-        pattern = re.compile('width=([0-9]*)[^height]+height=([0-9]*)')
-        match = pattern.search(str(result))
-        if match is None:
+        info = probe_media(videopath)
+        LOGGER.debug("ffprobe resolution = {}".format(info.resolution))
+        if info.height is None:
             return format_presets.VIDEO_LOW_RES
-        width, height = int(match.group(1)), int(match.group(2))
-        if height >= 720:
+        if info.height >= 720:
             LOGGER.info('Video preset from {} = high resolution'.format(videopath))
             return format_presets.VIDEO_HIGH_RES
         else:
@@ -36,41 +156,158 @@ def guess_video_preset_by_resolution(videopath):
         return format_presets.VIDEO_LOW_RES
 
 
-def extract_thumbnail_from_video(fpath_in, fpath_out, overwrite=False):
+# scale parameters are from https://trac.ffmpeg.org/wiki/Scaling
+THUMBNAIL_SCALE = "scale=400:225:force_original_aspect_ratio=decrease,pad=400:225:(ow-iw)/2:(oh-ih)/2"
+
+
+def extract_thumbnail_from_video(fpath_in, fpath_out, overwrite=False, fast_seek=False, candidates=1):
     """
     Extract a thumbnail from the video given through the `fobj_in` file object.
     The thumbnail image will be written in the file object given in `fobj_out`.
+    With `fast_seek`, ffmpeg seeks in the input instead of decoding every frame
+    up to the thumbnail, and `candidates` frames spread over the video are
+    extracted to keep the one with the highest entropy (the most detailed one).
     """
     try:
-        result = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
-                                          'default=noprint_wrappers=1:nokey=1', "-loglevel", "panic", str(fpath_in)])
-
-        midpoint = float(re.search("\d+\.\d+", str(result)).group()) / 2
-        # scale parameters are from https://trac.ffmpeg.org/wiki/Scaling
-        scale = "scale=400:225:force_original_aspect_ratio=decrease,pad=400:225:(ow-iw)/2:(oh-ih)/2"
-        command = ['ffmpeg',"-y" if overwrite else "-n", '-i', str(fpath_in), "-vf", scale, "-vcodec", "png", "-nostats",
-                  '-ss', str(midpoint), '-vframes', '1', '-q:v', '2', "-loglevel", "panic", str(fpath_out)]
-        subprocess.check_output(command, stderr=subprocess.STDOUT)
+        duration = probe_media(fpath_in).duration
+        if not duration:
+            raise ThumbnailGenerationError("Could not find the duration of {}".format(fpath_in))
+
+        if not fast_seek:
+            midpoint = duration / 2
+            command = ['ffmpeg',"-y" if overwrite else "-n", '-i', str(fpath_in), "-vf", THUMBNAIL_SCALE, "-vcodec", "png", "-nostats",
+                      '-ss', str(midpoint), '-vframes', '1', '-q:v', '2', "-loglevel", "panic", str(fpath_out)]
+            subprocess.check_output(command, stderr=subprocess.STDOUT)
+            return
+
+        if not overwrite and os.path.exists(str(fpath_out)):
+            return
+        temp_dir = tempfile.mkdtemp()
+        try:
+            frames = []
+            for index in range(max(1, candidates)):
+                frame_path = os.path.join(temp_dir, "{}.png".format(index))
+                _extract_frame(fpath_in, frame_path, duration * (index + 1) / (max(1, candidates) + 1))
+                if os.path.exists(frame_path):
+                    frames.append(frame_path)
+            if not frames:
+                raise ThumbnailGenerationError("Could not extract a frame from {}".format(fpath_in))
+            if len(frames) > 1:
+                # imported here to keep importing this module light
+                from PIL import Image
+                from .thumbscropping import image_entropy
+
+                def entropy(frame_path):
+                    with Image.open(frame_path) as im:
+                        return image_entropy(im)
+                frames.sort(key=entropy, reverse=True)
+            shutil.copyfile(frames[0], str(fpath_out))
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
     except subprocess.CalledProcessError as e:
         raise ThumbnailGenerationError("{}: {}".format(e, e.output))
 
 
-class VideoCompressionError(Exception):
+def _extract_frame(fpath_in, fpath_out, position):
     """
-    Custom error returned when `ffmpeg` compression exits with a non-zero status.
+    Save the frame of the video `fpath_in` at `position` seconds as a thumbnail PNG.
+    With `-ss` before `-i`, ffmpeg seeks to the keyframe before `position` and only
+    decodes the frames from there.
     """
-    pass
+    command = ['ffmpeg', '-y', '-ss', str(position), '-i', str(fpath_in), "-vf", THUMBNAIL_SCALE, "-vcodec", "png",
+               "-nostats", '-vframes', '1', '-q:v', '2', "-loglevel", "panic", str(fpath_out)]
+    subprocess.check_output(command, stderr=subprocess.STDOUT)
+
+
+SCENE_CHANGE_THRESHOLD = 0.3    # ffmpeg scene scores above this are scene changes
 
 
-def compress_video(source_file_path, target_file, overwrite=False, **kwargs):
+def extract_storyboard_from_video(fpath_in, output_dir, num_frames=9, threshold=SCENE_CHANGE_THRESHOLD,
+                                  fpath_tiled=None):
     """
-    Compress and scale video at `source_file_path` using setting provided in `kwargs`:
-      - max_height (int): set a limit for maximum vertical resolution (default: 480)
-      - max_width (int): set a limit for maximum horizontal resolution for video
-      - crf (int): set compression constant rate factor (default 32 = compress a lot)
-    Save compressed output video to `target_file`.
+    Save `num_frames` representative thumbnails of the video `fpath_in` in
+    `output_dir` as storyboard_01.png, storyboard_02.png, etc. The video is decoded
+    once: ffmpeg keeps the frames that start a new scene (scene score above
+    `threshold`) and at least one frame per `num_frames`-th of the video, then the
+    frame with the highest scene score in each `num_frames`-th is kept.
+    When `fpath_tiled` is given, the frames are also tiled into that image with
+    `create_tiled_image` (using the largest perfect square number of frames).
+    Returns the list of paths of the frames, in order.
+    """
+    try:
+        duration = probe_media(fpath_in).duration
+        if not duration:
+            raise ThumbnailGenerationError("Could not find the duration of {}".format(fpath_in))
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            interval = duration / num_frames
+            select = "select='gt(scene,{})+isnan(prev_selected_t)+gte(t-prev_selected_t,{})'".format(threshold, interval)
+            # metadata=print writes the time and scene score of each selected frame
+            command = ['ffmpeg', '-y', '-i', os.path.abspath(str(fpath_in)), '-an', '-sn',
+                       '-vf', ','.join([select, 'metadata=print:file=frames.txt', THUMBNAIL_SCALE]),
+                       '-vsync', 'vfr', '-nostats', '-loglevel', 'error', '%05d.png']
+            subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=temp_dir)
+
+            frames = []     # (time, scene score, path)
+            with open(os.path.join(temp_dir, 'frames.txt')) as frames_file:
+                for line in frames_file:
+                    if line.startswith('frame:'):
+                        fields = dict(field.split(':', 1) for field in line.split())
+                        frames.append([float(fields['pts_time']), 0.0,
+                                       os.path.join(temp_dir, '{:05d}.png'.format(int(fields['frame']) + 1))])
+                    elif line.startswith('lavfi.scene_score=') and frames:
+                        frames[-1][1] = float(line.split('=', 1)[1])
+
+            best_frames = {}
+            for time, score, path in frames:
+                window = min(int(time / interval), num_frames - 1)
+                if window not in best_frames or score > best_frames[window][1]:
+                    best_frames[window] = (time, score, path)
+            if not best_frames:
+                raise ThumbnailGenerationError("Could not extract frames from {}".format(fpath_in))
+
+            storyboard = []
+            for index, window in enumerate(sorted(best_frames)):
+                fpath_out = os.path.join(output_dir, 'storyboard_{:02d}.png'.format(index + 1))
+                shutil.copyfile(best_frames[window][2], fpath_out)
+                storyboard.append(fpath_out)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        if fpath_tiled:
+            # imported here to keep importing this module light
+            from .images import create_tiled_image
+            side = int(len(storyboard) ** 0.5)
+            create_tiled_image(storyboard[:side * side], fpath_tiled)
+        return storyboard
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise ThumbnailGenerationError("{}: {}".format(e, getattr(e, 'output', '')))
+
+
+AUDIO_BIT_RATE = 32             # kbps, the bitrate of the audio of compressed videos
+# MP4 overhead, measured at about 1.4KB plus 640 bytes per second (the sample tables
+# of ~25fps video and ~44.1kHz AAC audio), with some margin
+MUXING_OVERHEAD_BYTES = 4096    # bytes of container headers
+MUXING_OVERHEAD_RATE = 800      # bytes per second of container indexes
+MIN_VIDEO_BIT_RATE = 16         # kbps, the lowest usable video bitrate for target sizes
+MAX_TARGET_SIZE_PASSES = 4      # second passes tried to fit a target size before giving up
+
+# compression paths reported by `compress_video`
+COMPRESSION_ENCODED = 'encoded'     # the source was re-encoded
+COMPRESSION_REMUXED = 'remuxed'     # the source streams were copied to the target
+
+COMPLIANT_VIDEO_CODECS = ['h264']
+COMPLIANT_VIDEO_PROFILES = ['Baseline', 'Constrained Baseline', 'Main']
+COMPLIANT_AUDIO_CODECS = ['aac']
+DEFAULT_MAX_BIT_RATE = 1000     # kbps, the highest video bitrate of compliant sources
+DEFAULT_MAX_VIDEO_AUDIO_BIT_RATE = 36   # kbps, AUDIO_BIT_RATE with room for the encoder's overshoot
+
+
+def _get_scale_filter(**kwargs):
+    """
+    Return the ffmpeg scale filter for the `max_width` or `max_height` in `kwargs`.
     """
-    # scaling
     # The output width and height for ffmpeg scale param must be divisible by 2
     # using value -2 to get robust behaviour: maintains the aspect ratio and also
     # ensure the calculated dimension is divisible by 2
@@ -80,15 +317,637 @@ def compress_video(source_file_path, target_file, overwrite=False, **kwargs):
         scale = "'w=-2:h=trunc(min(ih,{max_height})/2)*2'".format(max_height=kwargs['max_height'])
     else:
         scale = "'w=-2:h=trunc(min(ih,480)/2)*2'"  # default to max-height 480px
+    return "scale={}".format(scale)
 
+
+def _get_encoder_args(**kwargs):
+    """
+    Return the ffmpeg codec options used to compress videos with the settings in `kwargs`.
+    """
     # set constant rate factor, see https://trac.ffmpeg.org/wiki/Encode/H.264#crf
     crf = kwargs['crf'] if 'crf' in kwargs else 32
+    rate_control = ["-b:v", "{}k".format(kwargs['video_bitrate'])] if kwargs.get('video_bitrate') else ["-crf", str(crf)]
+    args = ["-profile:v", "baseline", "-level", "3.0", "-b:a", "32k", "-ac", "1"] + rate_control + ["-preset", "slow"]
+    if kwargs.get('threads'):
+        args += ["-threads", str(kwargs['threads'])]
+    return args
 
-    # run command
-    command = ["ffmpeg", "-y" if overwrite else "-n", "-i", source_file_path, "-profile:v", "baseline",
-               "-level", "3.0", "-b:a", "32k", "-ac", "1", "-vf", "scale={}".format(scale),
-               "-crf", str(crf), "-preset", "slow", "-v", "error", "-strict", "-2", "-stats", target_file]
+
+def _get_encoding_args(**kwargs):
+    """
+    Return the ffmpeg output options used to compress videos with the settings in `kwargs`.
+    """
+    return ["-vf", _get_scale_filter(**kwargs)] + _get_encoder_args(**kwargs)
+
+
+def is_compliant_video(source_file_path, **kwargs):
+    """
+    Check if the video at `source_file_path` already meets the constraints that
+    `compress_video` would enforce, so it can be used without re-encoding:
+      - H.264 video with a baseline or main profile
+      - no audio, or mono AAC audio with a bitrate of at most `max_audio_bitrate`
+        kbps (default: 36, the 32 kbps of compressed videos plus some slack)
+      - no larger than `max_width` or `max_height` (default: 480)
+      - a video bitrate of at most `max_bitrate` kbps (default: 1000)
+    """
     try:
-        subprocess.check_output(command, stderr=subprocess.STDOUT)
+        info = probe_media(source_file_path)
+    except subprocess.CalledProcessError:
+        return False
+    if info.video_codec not in COMPLIANT_VIDEO_CODECS or info.video_profile not in COMPLIANT_VIDEO_PROFILES:
+        return False
+    if info.audio_stream is not None:
+        if info.audio_codec not in COMPLIANT_AUDIO_CODECS or info.channels != 1:
+            return False
+        max_audio_bitrate = kwargs.get('max_audio_bitrate', DEFAULT_MAX_VIDEO_AUDIO_BIT_RATE)
+        if info.audio_bit_rate is None or info.audio_bit_rate > max_audio_bitrate * 1000:
+            return False
+
+    # ffmpeg rotates videos before scaling them, so compare the displayed size
+    width, height = info.width, info.height
+    if info.rotation in (90, 270):
+        width, height = height, width
+    if 'max_width' in kwargs:
+        if width > kwargs['max_width']:
+            return False
+    elif height > kwargs.get('max_height', 480):
+        return False
+
+    bit_rate = info.video_bit_rate or info.bit_rate
+    max_bitrate = kwargs.get('max_bitrate', DEFAULT_MAX_BIT_RATE)
+    return bit_rate is not None and bit_rate <= max_bitrate * 1000
+
+
+def _get_progress_figures(progress):
+    """
+    Convert the raw `key=value` pairs of an ffmpeg `-progress` block to numbers.
+    """
+    def number(key, suffix=''):
+        value = progress.get(key, '')
+        return _to_float(value[:-len(suffix)] if suffix and value.endswith(suffix) else value)
+
+    out_time_us = number('out_time_us')
+    if out_time_us is None:
+        out_time_us = number('out_time_ms')  # microseconds as well, in older ffmpeg versions
+    return {
+        'frame': _to_int(progress.get('frame')),
+        'out_time': out_time_us / 1000000.0 if out_time_us is not None else None,
+        'fps': number('fps'),
+        'speed': number('speed', 'x'),
+        'bitrate': number('bitrate', 'kbits/s'),
+        'total_size': _to_int(progress.get('total_size')),
+        'done': progress.get('progress') == 'end',
+    }
+
+
+def _run_ffmpeg(command, progress_callback=None):
+    """
+    Run the ffmpeg `command`, raising a `VideoCompressionError` if it fails.
+    While ffmpeg runs, `progress_callback` is called with dicts of its progress:
+    `frame`, `out_time` (seconds), `fps`, `speed` (times realtime), `bitrate`
+    (kbps), `total_size` (bytes) and `done`.
+    Returns the CPU time used by ffmpeg in seconds, or None if it can't be measured.
+    """
+    if progress_callback:
+        command = command[:1] + ["-progress", "pipe:1"] + command[1:]
+    with tempfile.TemporaryFile() as output:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE if progress_callback else output,
+                                   stderr=output)
+        if progress_callback:
+            progress = {}
+            for line in iter(process.stdout.readline, b''):
+                key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+                progress[key] = value
+                if key == 'progress':   # the last line of each progress block
+                    progress_callback(_get_progress_figures(progress))
+                    progress = {}
+            process.stdout.close()
+
+        cpu_time = None
+        if hasattr(os, 'wait4'):
+            # wait4 reports the resources used by this ffmpeg process alone
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            cpu_time = rusage.ru_utime + rusage.ru_stime
+        else:
+            process.wait()
+
+        if process.returncode:
+            output.seek(0)
+            e = subprocess.CalledProcessError(process.returncode, command, output.read())
+            raise VideoCompressionError("{}: {}".format(e, e.output))
+    return cpu_time
+
+
+class CompressionMetrics(object):
+    """
+    Figures about a `compress_video` run: the path taken, the `wall_time` and the
+    `cpu_time` used by ffmpeg (in seconds, None if it couldn't be measured), and
+    the `input_size` and `output_size` of the video files (in bytes).
+    """
+    def __init__(self, path, wall_time, cpu_time, input_size, output_size):
+        self.path = path
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.input_size = input_size
+        self.output_size = output_size
+
+    @property
+    def compression_ratio(self):
+        """
+        How many times smaller the output is than the input.
+        """
+        return float(self.input_size) / self.output_size if self.output_size else None
+
+    def __repr__(self):
+        return "<CompressionMetrics {} wall_time={:.2f}s cpu_time={} ratio={}>".format(
+            self.path, self.wall_time, self.cpu_time, self.compression_ratio)
+
+
+def _get_compression_command(source_file_path, target_file, overwrite=False, **kwargs):
+    return ["ffmpeg", "-y" if overwrite else "-n", "-i", source_file_path] + _get_encoding_args(**kwargs) + \
+           ["-v", "error", "-strict", "-2", "-stats", target_file]
+
+
+def compress_video(source_file_path, target_file, overwrite=False, skip_if_compliant=False, segments=1,
+                   max_workers=None, target_size=None, progress_callback=None, metrics_callback=None, **kwargs):
+    """
+    Compress and scale video at `source_file_path` using setting provided in `kwargs`:
+      - max_height (int): set a limit for maximum vertical resolution (default: 480)
+      - max_width (int): set a limit for maximum horizontal resolution for video
+      - crf (int): set compression constant rate factor (default 32 = compress a lot)
+      - video_bitrate (int): encode at this average bitrate in kbps instead of using crf
+      - threads (int): the number of threads used by the encoder (default: ffmpeg's choice)
+      - max_bitrate (int): the highest video bitrate in kbps of sources that are
+        not re-encoded when `skip_if_compliant` is set (default: 1000)
+      - max_audio_bitrate (int): the highest audio bitrate in kbps of sources that
+        are not re-encoded when `skip_if_compliant` is set (default: 36)
+    Save compressed output video to `target_file`.
+    When `skip_if_compliant` is set and the source already meets these constraints
+    (see `is_compliant_video`), its streams are copied to `target_file` instead.
+    When `segments` is more than 1, the video is split into that many chunks at
+    keyframes and the chunks are encoded in parallel by up to `max_workers`
+    processes (see `compress_video_segments`).
+    When `target_size` is set, the video is encoded in two passes at the bitrate
+    that makes it fit in `target_size` bytes (see `get_target_video_bitrate`), and
+    a `VideoCompressionError` is raised if it can't fit. Two-pass encodes aren't
+    segmented: passing both `target_size` and `segments` raises a ValueError.
+    `progress_callback` is called with the live progress of ffmpeg (see `_run_ffmpeg`)
+    and `metrics_callback` with the `CompressionMetrics` of the run once it succeeds.
+    Segmented encodes run in other processes, so they can't report progress: passing
+    both `progress_callback` and `segments` raises a ValueError.
+    Returns the path taken, COMPRESSION_ENCODED or COMPRESSION_REMUXED.
+    """
+    if target_size and segments > 1:
+        raise ValueError("Compression to a target size can't be segmented")
+    start_time = time.time()
+    if skip_if_compliant and is_compliant_video(source_file_path, **kwargs) and \
+            (not target_size or os.path.getsize(source_file_path) <= target_size):
+        # copy the streams and move the index to the front for progressive playback
+        command = ["ffmpeg", "-y" if overwrite else "-n", "-i", source_file_path, "-c", "copy",
+                   "-sn", "-dn", "-movflags", "+faststart", "-v", "error", target_file]
+        path = COMPRESSION_REMUXED
+        cpu_time = _run_ffmpeg(command, progress_callback=progress_callback)
+    elif target_size:
+        path = COMPRESSION_ENCODED
+        kwargs['video_bitrate'] = get_target_video_bitrate(source_file_path, target_size)
+        cpu_time = _compress_two_pass(source_file_path, target_file, overwrite=overwrite, target_size=target_size,
+                                      progress_callback=progress_callback, **kwargs)
+    elif segments > 1:
+        if progress_callback:
+            raise ValueError("Segmented compression can't report progress")
+        path = COMPRESSION_ENCODED
+        cpu_time = compress_video_segments(source_file_path, target_file, overwrite=overwrite,
+                                           segments=segments, max_workers=max_workers, **kwargs)
+    else:
+        command = _get_compression_command(source_file_path, target_file, overwrite=overwrite, **kwargs)
+        path = COMPRESSION_ENCODED
+        cpu_time = _run_ffmpeg(command, progress_callback=progress_callback)
+
+    metrics = CompressionMetrics(path, time.time() - start_time, cpu_time,
+                                 os.path.getsize(source_file_path), os.path.getsize(target_file))
+    LOGGER.debug("Compressed {} to {}: {}".format(source_file_path, target_file, metrics))
+    if metrics_callback:
+        metrics_callback(metrics)
+    return path
+
+
+def get_target_video_bitrate(source_file_path, target_size):
+    """
+    Return the video bitrate in kbps at which `compress_video` fits the video at
+    `source_file_path` in `target_size` bytes, given its duration, the audio
+    bitrate and the container overhead, which grows with the duration.
+    Raises a `VideoCompressionError` if the video can't fit in `target_size`.
+    """
+    try:
+        info = probe_media(source_file_path)
+    except subprocess.CalledProcessError as e:
+        raise VideoCompressionError("{}: {}".format(e, e.output))
+    if not info.duration:
+        raise VideoCompressionError("Could not find the duration of {}".format(source_file_path))
+    muxing_overhead = MUXING_OVERHEAD_BYTES + MUXING_OVERHEAD_RATE * info.duration
+    total_bitrate = (target_size - muxing_overhead) * 8 / 1000.0 / info.duration
+    video_bitrate = int(total_bitrate - (AUDIO_BIT_RATE if info.audio_stream is not None else 0))
+    if video_bitrate < MIN_VIDEO_BIT_RATE:
+        raise VideoCompressionError("{} can't fit in {} bytes".format(source_file_path, target_size))
+    return video_bitrate
+
+
+def _compress_two_pass(source_file_path, target_file, overwrite=False, target_size=None,
+                       progress_callback=None, **kwargs):
+    """
+    Encode the video in two passes at `kwargs['video_bitrate']`: the first pass
+    analyses the video so the second one can spend the bits where they are needed.
+    While the output is larger than `target_size`, the second pass is run again at
+    a bitrate lowered by the overshoot, up to `MAX_TARGET_SIZE_PASSES` times in all.
+    Raises a `VideoCompressionError` (and removes the output) if it still doesn't fit.
+    Like ffmpeg's `-n`, an existing `target_file` is kept unless `overwrite` is set.
+    Returns the CPU time used by ffmpeg in seconds, or None if it can't be measured.
+    """
+    if not overwrite and os.path.exists(target_file):
+        LOGGER.debug("Not compressing {}: {} already exists".format(source_file_path, target_file))
+        return 0.0
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        passlogfile = os.path.join(temp_dir, "passlog")
+        first_pass = ["ffmpeg", "-y", "-i", source_file_path, "-c:v", "libx264"] + _get_encoding_args(**kwargs) + \
+                     ["-pass", "1", "-passlogfile", passlogfile, "-an", "-v", "error", "-f", "null", "-"]
+        cpu_times = [_run_ffmpeg(first_pass)]
+        for attempt in range(MAX_TARGET_SIZE_PASSES):
+            second_pass = ["ffmpeg", "-y", "-i", source_file_path] + _get_encoding_args(**kwargs) + \
+                          ["-pass", "2", "-passlogfile", passlogfile, "-v", "error", "-strict", "-2", target_file]
+            cpu_times.append(_run_ffmpeg(second_pass, progress_callback=progress_callback))
+
+            size = os.path.getsize(target_file)
+            if not target_size or size <= target_size:
+                return sum(cpu_times) if None not in cpu_times else None
+
+            # x264 overshoots low bitrates on videos that are hard to compress
+            video_bitrate = kwargs['video_bitrate']
+            overshoot = (size - target_size) * 8 / 1000.0 / probe_media(source_file_path).duration
+            kwargs['video_bitrate'] = min(video_bitrate - 1, int(video_bitrate ** 2 / (video_bitrate + overshoot)))
+            if kwargs['video_bitrate'] < MIN_VIDEO_BIT_RATE:
+                break
+            LOGGER.debug("{} is {} bytes over {}, encoding again at {}kbps".format(
+                target_file, size - target_size, target_size, kwargs['video_bitrate']))
+
+        os.remove(target_file)
+        raise VideoCompressionError("{} can't fit in {} bytes (got {} bytes)".format(
+            source_file_path, target_size, size))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def compress_video_to_size(source_file_path, target_file, target_size, overwrite=False, **kwargs):
+    """
+    Compress the video at `source_file_path` with a two-pass encode so that
+    `target_file` fits in `target_size` bytes, using the `compress_video` settings
+    in `kwargs` (crf is ignored).
+    Returns the size of `target_file` in bytes, which is at most `target_size`.
+    Raises a `VideoCompressionError` if the video can't fit in `target_size`.
+    """
+    compress_video(source_file_path, target_file, overwrite=overwrite, target_size=target_size, **kwargs)
+    return os.path.getsize(target_file)
+
+
+def compress_video_segments(source_file_path, target_file, overwrite=False, segments=None,
+                            max_workers=None, **kwargs):
+    """
+    Compress the video at `source_file_path` like `compress_video`, but split it
+    at keyframes into `segments` chunks (default: the number of CPUs) that are
+    encoded concurrently by up to `max_workers` processes. The audio is encoded
+    once alongside the chunks, and everything is joined without re-encoding
+    using the concat demuxer. Save compressed output video to `target_file`.
+    Like ffmpeg's `-n`, an existing `target_file` is kept unless `overwrite` is set.
+    Returns the total CPU time used by ffmpeg in seconds, or None if it can't be measured.
+    """
+    if not overwrite and os.path.exists(target_file):
+        LOGGER.debug("Not compressing {}: {} already exists".format(source_file_path, target_file))
+        return 0.0
+    try:
+        info = probe_media(source_file_path)
     except subprocess.CalledProcessError as e:
         raise VideoCompressionError("{}: {}".format(e, e.output))
+    cpu_count = multiprocessing.cpu_count()
+    segments = segments or cpu_count
+    if not info.duration or info.video_stream is None or segments < 2:
+        return _run_ffmpeg(_get_compression_command(source_file_path, target_file, overwrite=overwrite, **kwargs))
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # split the video stream without re-encoding; every chunk starts at the
+        # first keyframe after its split point so they can be decoded on their own
+        split_times = [info.duration * i / segments for i in range(1, segments)]
+        cpu_times = [_run_ffmpeg(["ffmpeg", "-y", "-i", source_file_path, "-map", "0:v:0", "-c", "copy",
+                     "-f", "segment", "-segment_times", ",".join("{:.3f}".format(t) for t in split_times),
+                     "-reset_timestamps", "1", "-v", "error", os.path.join(temp_dir, "source%04d.mp4")])]
+        sources = sorted(name for name in os.listdir(temp_dir) if name.startswith("source"))
+
+        # share the CPUs between the concurrent encoders
+        commands = []
+        audio_path = os.path.join(temp_dir, "audio.m4a")
+        if info.audio_stream is not None:
+            commands.append(["ffmpeg", "-y", "-i", source_file_path, "-vn", "-sn", "-dn", "-b:a", "32k",
+                             "-ac", "1", "-v", "error", "-strict", "-2", audio_path])
+        workers = min(max_workers or cpu_count, len(sources) + len(commands))
+        kwargs.setdefault('threads', max(1, cpu_count // workers))
+        for name in sources:
+            commands.append(["ffmpeg", "-y", "-i", os.path.join(temp_dir, name), "-an"] + _get_encoding_args(**kwargs) +
+                            ["-v", "error", os.path.join(temp_dir, "encoded" + name[6:])])
+        cpu_times += run_in_process_pool(_run_ffmpeg, commands, max_workers=workers)
+
+        list_path = os.path.join(temp_dir, "segments.txt")
+        with open(list_path, "w") as list_file:
+            for name in sources:
+                list_file.write("file 'encoded{}'\n".format(name[6:]))
+        command = ["ffmpeg", "-y" if overwrite else "-n", "-f", "concat", "-safe", "0", "-i", list_path]
+        if info.audio_stream is not None:
+            command += ["-i", audio_path, "-map", "0:v", "-map", "1:a"]
+        cpu_times.append(_run_ffmpeg(command + ["-c", "copy", "-movflags", "+faststart", "-v", "error", target_file]))
+        LOGGER.debug("Compressed {} to {} in {} segments".format(source_file_path, target_file, len(sources)))
+        return sum(cpu_times) if None not in cpu_times else None
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+
+def compress_video_renditions(source_file_path, renditions, overwrite=False, progress_callback=None, **kwargs):
+    """
+    Compress the video at `source_file_path` to several outputs in one ffmpeg
+    process, decoding the source only once and splitting the decoded frames
+    between the renditions. `renditions` is a list of ``(target_file, options)``
+    where `options` is a dict of `compress_video` settings (max_height, max_width,
+    crf) for that output, on top of the settings in `kwargs`. For example::
+
+        compress_video_renditions(source, [('high.mp4', {'max_height': 720, 'crf': 28}),
+                                           ('low.mp4', {'max_height': 480})])
+
+    `progress_callback` is called as in `compress_video`.
+    Returns the list of target files.
+    """
+    if not renditions:
+        return []
+    try:
+        has_audio = probe_media(source_file_path).audio_stream is not None
+    except subprocess.CalledProcessError as e:
+        raise VideoCompressionError("{}: {}".format(e, e.output))
+
+    # [0:v]split=2[in0][in1];[in0]scale=...[out0];[in1]scale=...[out1]
+    filters = ["[0:v]split={}{}".format(len(renditions), "".join("[in{}]".format(i) for i in range(len(renditions))))]
+    outputs = []
+    for index, (target_file, options) in enumerate(renditions):
+        options = dict(kwargs, **(options or {}))
+        filters.append("[in{index}]{scale}[out{index}]".format(index=index, scale=_get_scale_filter(**options)))
+        outputs += ["-map", "[out{}]".format(index)] + (["-map", "0:a:0"] if has_audio else []) + \
+            _get_encoder_args(**options) + ["-strict", "-2", target_file]
+    command = ["ffmpeg", "-y" if overwrite else "-n", "-i", source_file_path, "-filter_complex", ";".join(filters),
+               "-v", "error"] + outputs
+    _run_ffmpeg(command, progress_callback=progress_callback)
+    LOGGER.debug("Compressed {} to {} renditions".format(source_file_path, len(renditions)))
+    return [target_file for target_file, _ in renditions]
+
+
+# BATCH VIDEO COMPRESSION
+################################################################################
+
+COMPRESSION_SKIPPED = 'skipped'         # the target already existed
+COMPRESSION_CANCELLED = 'cancelled'     # the job was cancelled before it started
+THREADS_PER_JOB = 4     # x264 gains little from more threads on low resolution videos
+
+
+def get_compression_concurrency(max_workers=None):
+    """
+    Return the number of videos to compress at once and the number of encoder
+    threads for each of them, so that together they use all the CPUs.
+    """
+    cpu_count = multiprocessing.cpu_count()
+    workers = max_workers or max(1, cpu_count // THREADS_PER_JOB)
+    return workers, max(1, cpu_count // workers)
+
+
+def _compress_job(source_file_path, target_file, overwrite, kwargs):
+    """
+    Run a single job for `VideoCompressionQueue`, returning the error instead of raising it.
+    """
+    if not overwrite and os.path.exists(target_file):
+        return COMPRESSION_SKIPPED
+    try:
+        return compress_video(source_file_path, target_file, overwrite=overwrite, **kwargs)
+    except VideoCompressionError as e:
+        return e
+    except Exception as e:
+        return VideoCompressionError("Fail on {} {}".format(source_file_path, e))
+
+
+class VideoCompressionQueue(object):
+    """
+    A queue of videos to compress with `compress_video`. Running the queue
+    compresses up to `max_workers` videos at once (by default enough to keep all
+    the CPUs busy with `THREADS_PER_JOB` encoder threads each), starting with the
+    jobs of highest priority. Jobs whose target already exists are skipped unless
+    `overwrite` is set. The `results` dict maps each job id to the path taken by
+    `compress_video`, COMPRESSION_SKIPPED, COMPRESSION_CANCELLED or the
+    VideoCompressionError that the job failed with.
+    """
+    def __init__(self, max_workers=None, overwrite=False):
+        self.max_workers, self.threads = get_compression_concurrency(max_workers)
+        self.overwrite = overwrite
+        self.results = OrderedDict()    # in the order the jobs finished
+        self._queue = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add(self, source_file_path, target_file, priority=0, **kwargs):
+        """
+        Queue the compression of `source_file_path` to `target_file` with the
+        `compress_video` settings in `kwargs`. Jobs can be added while the queue runs.
+
+        :return: The id of the job
+        """
+        kwargs.setdefault('threads', self.threads)
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+            # higher priorities first, then in the order the jobs were added
+            heapq.heappush(self._queue, (-priority, job_id, source_file_path, target_file, kwargs))
+        return job_id
+
+    def cancel(self, job_id):
+        """
+        Cancel the job `job_id` if it hasn't started yet.
+
+        :return: True if the job was cancelled
+        """
+        with self._lock:
+            for index, job in enumerate(self._queue):
+                if job[1] == job_id:
+                    self._queue.pop(index)
+                    heapq.heapify(self._queue)
+                    self.results[job_id] = COMPRESSION_CANCELLED
+                    return True
+        return False
+
+    def run(self):
+        """
+        Compress all the queued videos and return the `results` dict.
+        """
+        workers = [threading.Thread(target=self._work) for _ in range(self.max_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.results
+
+    def _work(self):
+        # ffmpeg does the work in its own process, so threads are enough here
+        while True:
+            with self._lock:
+                if not self._queue:
+                    return
+                _, job_id, source_file_path, target_file, kwargs = heapq.heappop(self._queue)
+            self.results[job_id] = _compress_job(source_file_path, target_file, self.overwrite, kwargs)
+
+
+def compress_videos(jobs, max_workers=None, overwrite=False):
+    """
+    Compress many videos concurrently using a `VideoCompressionQueue`.
+    Each job is a tuple ``(source_file_path, target_file, options)`` where `options`
+    is a dict of keyword arguments (or None) for `compress_video`.
+    Returns a list with, for each job in order, the path taken by `compress_video`,
+    COMPRESSION_SKIPPED or the VideoCompressionError that it failed with.
+    """
+    queue = VideoCompressionQueue(max_workers=max_workers, overwrite=overwrite)
+    job_ids = [queue.add(source_file_path, target_file, **(options or {}))
+               for source_file_path, target_file, options in jobs]
+    results = queue.run()
+    return [results[job_id] for job_id in job_ids]
+
+
+def compress_videos_to_size(jobs, total_size, max_workers=None, overwrite=False):
+    """
+    Compress many videos concurrently so that together they fit in `total_size`
+    bytes. Each job is a tuple ``(source_file_path, target_file, options)`` like
+    in `compress_videos`. The budget is split between the videos by duration,
+    so they all get the same bitrate.
+    Returns a list with, for each job in order, the size of its `target_file` in
+    bytes or the VideoCompressionError that it failed with.
+    """
+    durations = []
+    for source_file_path, _, _ in jobs:
+        try:
+            durations.append(probe_media(source_file_path).duration)
+        except subprocess.CalledProcessError:
+            durations.append(None)
+    total_duration = sum(duration for duration in durations if duration)
+
+    sized_jobs = [(source_file_path, target_file, dict(options or {}, target_size=int(total_size * duration / total_duration)))
+                  for (source_file_path, target_file, options), duration in zip(jobs, durations) if duration]
+    results = iter(compress_videos(sized_jobs, max_workers=max_workers, overwrite=overwrite))
+    sizes = []
+    for (source_file_path, target_file, _), duration in zip(jobs, durations):
+        if not duration:
+            sizes.append(VideoCompressionError("Could not find the duration of {}".format(source_file_path)))
+            continue
+        result = next(results)
+        sizes.append(result if isinstance(result, VideoCompressionError) else os.path.getsize(target_file))
+    return sizes
+
+
+
+# AUDIO FUNCTIONS
+################################################################################
+
+AUDIO_CODECS = {'.mp3': 'mp3'}     # target file extension -> codec, AAC otherwise
+AUDIO_ENCODERS = {'aac': 'aac', 'mp3': 'libmp3lame'}
+DEFAULT_AUDIO_SAMPLE_RATE = 22050   # Hz, plenty for speech
+DEFAULT_MAX_AUDIO_BIT_RATE = 64     # kbps, the highest bitrate of compliant audio sources
+
+
+def _get_audio_codec(target_file):
+    return AUDIO_CODECS.get(os.path.splitext(target_file)[1].lower(), 'aac')
+
+
+def is_compliant_audio(source_file_path, target_file, **kwargs):
+    """
+    Check if the audio at `source_file_path` can be copied as is to `target_file`
+    instead of being compressed by `compress_audio` with the settings in `kwargs`:
+    it is mono, encoded with the codec of `target_file` (MP3 for .mp3 files, AAC
+    otherwise) at no more than `sample_rate` Hz and `max_bitrate` kbps (default: 64).
+    """
+    try:
+        info = probe_media(source_file_path)
+    except subprocess.CalledProcessError:
+        return False
+    if info.audio_codec != _get_audio_codec(target_file) or info.channels != 1:
+        return False
+    if info.sample_rate is None or info.sample_rate > kwargs.get('sample_rate', DEFAULT_AUDIO_SAMPLE_RATE):
+        return False
+    bit_rate = info.audio_bit_rate or info.bit_rate
+    max_bitrate = kwargs.get('max_bitrate', DEFAULT_MAX_AUDIO_BIT_RATE)
+    return bit_rate is not None and bit_rate <= max_bitrate * 1000
+
+
+def compress_audio(source_file_path, target_file, overwrite=False, skip_if_compliant=False, **kwargs):
+    """
+    Compress the audio of `source_file_path` to a mono `target_file` using setting
+    provided in `kwargs`:
+      - bitrate (int): the audio bitrate in kbps (default: 32)
+      - sample_rate (int): the highest sample rate in Hz (default: 22050)
+      - max_bitrate (int): the highest bitrate in kbps of sources that are not
+        re-encoded when `skip_if_compliant` is set (default: 64)
+    The codec is picked from the extension of `target_file`: MP3 for .mp3 files
+    and AAC otherwise. When `skip_if_compliant` is set and the source already
+    meets these constraints (see `is_compliant_audio`), its audio stream is
+    copied to `target_file` instead. Raises a `VideoCompressionError` if ffmpeg fails.
+    Returns the path taken, COMPRESSION_ENCODED or COMPRESSION_REMUXED.
+    """
+    command = ["ffmpeg", "-y" if overwrite else "-n", "-i", source_file_path, "-map", "0:a:0"]
+    if skip_if_compliant and is_compliant_audio(source_file_path, target_file, **kwargs):
+        command += ["-c", "copy"]
+        path = COMPRESSION_REMUXED
+    else:
+        sample_rate = kwargs.get('sample_rate', DEFAULT_AUDIO_SAMPLE_RATE)
+        try:
+            # never upsample
+            sample_rate = min(sample_rate, probe_media(source_file_path).sample_rate or sample_rate)
+        except subprocess.CalledProcessError:
+            pass    # let ffmpeg report the error
+        command += ["-c:a", AUDIO_ENCODERS[_get_audio_codec(target_file)], "-b:a", "{}k".format(kwargs.get('bitrate', 32)),
+                    "-ac", "1", "-ar", str(sample_rate), "-strict", "-2"]
+        path = COMPRESSION_ENCODED
+    if _get_audio_codec(target_file) == 'aac':
+        command += ["-movflags", "+faststart"]
+    _run_ffmpeg(command + ["-v", "error", target_file])
+    LOGGER.debug("Compressed {} to {} ({})".format(source_file_path, target_file, path))
+    return path
+
+
+def _compress_audio_job(job):
+    """
+    Run a single job for `compress_audio_files`, returning the error instead of raising it.
+    """
+    source_file_path, target_file, overwrite, options = job
+    if not overwrite and os.path.exists(target_file):
+        return COMPRESSION_SKIPPED
+    try:
+        return compress_audio(source_file_path, target_file, overwrite=overwrite, **(options or {}))
+    except VideoCompressionError as e:
+        return e
+    except Exception as e:
+        return VideoCompressionError("Fail on {} {}".format(source_file_path, e))
+
+
+def compress_audio_files(jobs, max_workers=None, overwrite=False):
+    """
+    Compress many audio files in parallel in a pool of at most `max_workers`
+    processes (defaults to the number of CPUs, audio encoders use a single thread).
+    Each job is a tuple ``(source_file_path, target_file, options)`` where `options`
+    is a dict of keyword arguments (or None) for `compress_audio`. Targets that
+    already exist are skipped unless `overwrite` is set.
+    Returns a list with, for each job in order, the path taken by `compress_audio`,
+    COMPRESSION_SKIPPED or the VideoCompressionError that it failed with.
+    """
+    return run_in_process_pool(_compress_audio_job, [(source_file_path, target_file, overwrite, options)
+                                                     for source_file_path, target_file, options in jobs],
+                               max_workers=max_workers)
@@ -22,6 +22,7 @@ requirements = [
 ]
 if sys.version_info < (3, 0, 0):
     requirements.append("pathlib>=1.0.1")
+    requirements.append("futures>=3.1.1")
 
 test_requirements = [
     # TODO: put package test requirements here
@@ -0,0 +1,94 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+HEAVY_MODULES = ['numpy', 'matplotlib', 'PIL', 'ebooklib', 'pdf2image', 'pycaption']
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.time()
+{imports}
+elapsed = time.time() - start
+print(json.dumps({{'elapsed': elapsed, 'modules': sorted(sys.modules)}}))
+"""
+
+# what importing pressurecooker.images used to load eagerly
+EAGER_IMPORTS = """
+import numpy, matplotlib
+matplotlib.use('PS')
+import matplotlib.pyplot, PIL.Image, ebooklib.epub, pdf2image
+"""
+IMPORT_TIME_RUNS = 3
+MAX_IMPORT_TIME_RATIO = 0.25    # of the time taken by EAGER_IMPORTS
+
+
+def import_in_subprocess(module, imports=None):
+    """
+    Import `module` (or run the `imports` statements) in a fresh interpreter and
+    return how long it took (in seconds) and which modules ended up loaded.
+    """
+    script = IMPORT_SCRIPT.format(imports=imports or 'import {}'.format(module))
+    output = subprocess.check_output([sys.executable, '-c', script])
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    return result['elapsed'], set(name.split('.')[0] for name in result['modules'])
+
+
+def get_import_time(module, imports=None):
+    """
+    Return the best time in seconds of `IMPORT_TIME_RUNS` imports in fresh interpreters.
+    """
+    return min(import_in_subprocess(module, imports)[0] for _ in range(IMPORT_TIME_RUNS))
+
+
+@pytest.mark.parametrize('module', [
+    'pressurecooker.images',
+    'pressurecooker.videos',
+    'pressurecooker.exceptions',
+])
+def test_import_does_not_load_heavy_modules(module):
+    _, modules = import_in_subprocess(module)
+    loaded = [name for name in HEAVY_MODULES if name in modules]
+    assert not loaded, 'importing {} loaded {}'.format(module, loaded)
+
+
+@pytest.mark.parametrize('module', [
+    'pressurecooker.images',
+    'pressurecooker.videos',
+])
+def test_import_time_benchmark(module):
+    # compared with the eager imports timed on the same machine, so the threshold
+    # doesn't depend on how fast the machine is
+    import_time = get_import_time(module)
+    eager_import_time = get_import_time(None, EAGER_IMPORTS)
+    assert import_time < eager_import_time * MAX_IMPORT_TIME_RATIO, \
+        'importing {} took {:.3f}s, eager imports took {:.3f}s'.format(module, import_time, eager_import_time)
+
+
+NUMPY_WAVEFORM_SCRIPT = """
+import json, sys
+from pressurecooker import images
+images.create_waveform_image({fpath_in!r}, {fpath_out!r}, streaming=True, renderer='numpy')
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def test_numpy_waveform_renderer_does_not_load_matplotlib_figures(tmpdir):
+    fpath_in = os.path.join(os.path.dirname(__file__), 'files', 'Wilhelm_Scream.mp3')
+    fpath_out = tmpdir.join('waveform.png').strpath
+    script = NUMPY_WAVEFORM_SCRIPT.format(fpath_in=fpath_in, fpath_out=fpath_out)
+    output = subprocess.check_output([sys.executable, '-c', script])
+    modules = set(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    for module in ['matplotlib.pyplot', 'matplotlib.figure', 'matplotlib.backends.backend_agg']:
+        assert module not in modules
+    assert os.path.exists(fpath_out)
+
+
+def test_exceptions_are_shared():
+    from pressurecooker import exceptions, images, videos
+    assert images.ThumbnailGenerationError is exceptions.ThumbnailGenerationError
+    assert videos.ThumbnailGenerationError is exceptions.ThumbnailGenerationError
+    assert videos.VideoCompressionError is exceptions.VideoCompressionError
@@ -1,3 +1,5 @@
+import io
+import mmap
 import os
 import hashlib
 import tempfile
@@ -6,10 +8,27 @@ from pressurecooker.subtitles import build_subtitle_converter_from_file
 from pressurecooker.subtitles import LANGUAGE_CODE_UNKNOWN
 from pressurecooker.subtitles import InvalidSubtitleFormatError
 from pressurecooker.subtitles import InvalidSubtitleLanguageError
+from pressurecooker.subtitles import build_subtitle_readers, sniff_subtitle_format
+from pressurecooker.subtitles import build_subtitle_reader, convert_subtitle_files
+from pressurecooker.subtitles import build_subtitle_converter, stream_subtitle_file
+from pressurecooker.subtitles import detect_subtitle_encoding
 from le_utils.constants import languages, file_formats
 
 test_files_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'files', 'subtitles')
 
+MULTILANGUAGE_DFXP = u"""<?xml version="1.0" encoding="UTF-8"?>
+<tt xmlns="http://www.w3.org/ns/ttml" xml:lang="en">
+  <body>
+    <div xml:lang="en">
+      <p begin="00:00:01.000" end="00:00:02.000">Hello</p>
+    </div>
+    <div xml:lang="fr">
+      <p begin="00:00:01.000" end="00:00:02.000">Bonjour</p>
+    </div>
+  </body>
+</tt>
+"""
+
 
 class SubtitleConverterTest(TestCase):
     def get_file_hash(self, path):
@@ -106,3 +125,149 @@ class SubtitleConverterTest(TestCase):
 
         with self.assertRaises(InvalidSubtitleLanguageError):
             converter.convert(expected_language.code)
+
+    def test_sniff_subtitle_format(self):
+        expected_formats = {
+            'basic.srt': file_formats.SRT,
+            'basic.vtt': file_formats.VTT,
+            'empty.ttml': file_formats.DFXP,
+            'encapsulated.sami': file_formats.SAMI,
+            'not.txt': None,
+        }
+        for filename, expected_format in expected_formats.items():
+            with open(os.path.join(test_files_dir, filename), 'rb') as captions_file:
+                captions_str = captions_file.read().decode('utf-8')
+            self.assertEqual(sniff_subtitle_format(captions_str), expected_format, filename)
+        self.assertEqual(sniff_subtitle_format(u'Scenarist_SCC V1.0\n\n'), file_formats.SCC)
+
+    def test_sniffed_reader_is_tried_first(self):
+        readers = build_subtitle_readers(first_format=file_formats.SAMI)
+        self.assertEqual(type(readers[0].reader).__name__, 'SAMIReader')
+        # TTML and DFXP use the same reader, which is only built once
+        self.assertEqual(len(set(type(reader.reader) for reader in readers)), len(readers))
+
+    def test_shared_readers(self):
+        self.assertIs(build_subtitle_reader(file_formats.SRT, shared=True),
+                      build_subtitle_reader(file_formats.SRT, shared=True))
+        # SCCReader keeps state between reads so it's never shared
+        self.assertIsNot(build_subtitle_reader(file_formats.SCC, shared=True),
+                         build_subtitle_reader(file_formats.SCC, shared=True))
+
+    def test_convert_subtitle_files(self):
+        arabic = languages.getlang_by_name('Arabic').code
+        english = languages.getlang_by_name('English').code
+        spanish = languages.getlang_by_name('Spanish').code
+        out_dir = tempfile.mkdtemp()
+        jobs = [
+            (os.path.join(test_files_dir, 'basic.srt'), os.path.join(out_dir, 'basic.vtt'), arabic),
+            (os.path.join(test_files_dir, 'encapsulated.sami'), os.path.join(out_dir, 'en.vtt'), english),
+            (os.path.join(test_files_dir, 'encapsulated.sami'), os.path.join(out_dir, 'es.vtt'), spanish),
+            (os.path.join(test_files_dir, 'not.txt'), os.path.join(out_dir, 'not.vtt'), english),
+            (os.path.join(test_files_dir, 'basic.srt'), os.path.join(out_dir, 'basic2.vtt'), arabic),
+        ]
+        for max_workers in [1, 2]:
+            results = convert_subtitle_files(jobs, max_workers=max_workers)
+
+            self.assertEqual(results[0], jobs[0][1])
+            self.assertFileHashesEqual(os.path.join(test_files_dir, 'basic.vtt'), results[0])
+            self.assertFileHashesEqual(os.path.join(test_files_dir, 'encapsulated.vtt'), results[1])
+            self.assertIsInstance(results[2], InvalidSubtitleLanguageError)
+            self.assertIsInstance(results[3], InvalidSubtitleFormatError)
+            self.assertFileHashesEqual(os.path.join(test_files_dir, 'basic.vtt'), results[4])
+
+    def test_write_all(self):
+        converter = build_subtitle_converter(MULTILANGUAGE_DFXP)
+        out_dir = tempfile.mkdtemp()
+
+        out_filenames = converter.write_all(out_dir)
+        self.assertEqual(sorted(out_filenames), ['en', 'fr'])
+        for lang_code, out_filename in out_filenames.items():
+            self.assertEqual(out_filename, os.path.join(out_dir, '{}.vtt'.format(lang_code)))
+            with open(out_filename, 'rb') as converted_file:
+                self.assertEqual(converted_file.read().decode('utf-8'), converter.convert(lang_code))
+
+        out_filenames = converter.write_all(os.path.join(out_dir, 'captions_{lang_code}.vtt'))
+        self.assertEqual(out_filenames['fr'], os.path.join(out_dir, 'captions_fr.vtt'))
+        self.assertTrue(os.path.exists(out_filenames['en']))
+
+    def test_stream_subtitle_file(self):
+        expected_file = os.path.join(test_files_dir, 'basic.vtt')
+        out_filename = os.path.join(tempfile.mkdtemp(), 'basic.vtt')
+
+        self.assertTrue(stream_subtitle_file(os.path.join(test_files_dir, 'basic.srt'), out_filename))
+        self.assertFileHashesEqual(expected_file, out_filename)
+
+    def test_stream_subtitle_file__same_as_converter(self):
+        captions_str = u"WEBVTT\n\nNOTE a comment\n\n1\n00:01.000 --> 00:02.500\n  Fish and chips  \n\n" \
+                       u"1:00:03.000 --> 1:00:04.000\n\u00e9t\u00e9\n \nlast"
+        captions_filename = os.path.join(tempfile.mkdtemp(), 'captions.vtt')
+        with open(captions_filename, 'wb') as captions_file:
+            captions_file.write(captions_str.encode('utf-8'))
+        out_filename = captions_filename + '.out'
+
+        self.assertTrue(stream_subtitle_file(captions_filename, out_filename))
+        with open(out_filename, 'rb') as converted_file:
+            self.assertEqual(converted_file.read().decode('utf-8'),
+                             build_subtitle_converter(captions_str).convert(LANGUAGE_CODE_UNKNOWN))
+
+    def test_stream_subtitle_file__fallback(self):
+        out_dir = tempfile.mkdtemp()
+        for filename in ['encapsulated.vtt', 'encapsulated.sami', 'empty.ttml', 'not.txt']:
+            out_filename = os.path.join(out_dir, filename + '.vtt')
+            self.assertFalse(stream_subtitle_file(os.path.join(test_files_dir, filename), out_filename))
+            self.assertFalse(os.path.exists(out_filename))
+
+    def test_detect_subtitle_encoding(self):
+        captions_str = u"1\n00:00:01,000 --> 00:00:02,000\nCaf\u00e9 \u201cnoir\u201d\n"
+        expected_encodings = {
+            'utf-8': 'utf-8',
+            'utf-8-sig': 'utf-8-sig',
+            'utf-16': 'utf-16',
+            'utf-16-le': 'utf-16-le',
+            'utf-16-be': 'utf-16-be',
+            'utf-32': 'utf-32',
+            'cp1252': 'cp1252',
+        }
+        for encoding, expected_encoding in expected_encodings.items():
+            self.assertEqual(detect_subtitle_encoding(captions_str.encode(encoding)), expected_encoding)
+        self.assertEqual(detect_subtitle_encoding(b'\x81\x8d'), 'latin-1')
+
+    def test_non_utf8_files(self):
+        with io.open(os.path.join(test_files_dir, 'basic.srt'), encoding='utf-8', newline='') as srt_file:
+            srt_str = srt_file.read()
+        out_dir = tempfile.mkdtemp()
+        expected_file = os.path.join(test_files_dir, 'basic.vtt')
+
+        for encoding in ['utf-8-sig', 'utf-16', 'utf-16-le', 'utf-16-be']:
+            captions_filename = os.path.join(out_dir, '{}.srt'.format(encoding))
+            with open(captions_filename, 'wb') as captions_file:
+                captions_file.write(srt_str.encode(encoding))
+
+            converter = build_subtitle_converter_from_file(captions_filename)
+            out_filename = os.path.join(out_dir, '{}.vtt'.format(encoding))
+            converter.write(out_filename, LANGUAGE_CODE_UNKNOWN)
+            self.assertFileHashesEqual(expected_file, out_filename)
+
+            self.assertTrue(stream_subtitle_file(captions_filename, out_filename))
+            self.assertFileHashesEqual(expected_file, out_filename)
+
+    def test_bytes_input(self):
+        with io.open(os.path.join(test_files_dir, 'encapsulated.sami'), encoding='utf-8') as sami_file:
+            sami_str = sami_file.read()
+        expected = build_subtitle_converter(sami_str).convert('en')
+
+        converter = build_subtitle_converter(sami_str.encode('utf-16'))
+        self.assertEqual(converter.convert('en'), expected)
+        converter = build_subtitle_converter(sami_str.encode('utf-16-le'), encoding='utf-16-le')
+        self.assertEqual(converter.convert('en'), expected)
+
+        with tempfile.TemporaryFile() as captions_file:
+            captions_file.write(sami_str.encode('utf-16'))
+            captions_file.flush()
+            captions_map = mmap.mmap(captions_file.fileno(), 0, access=mmap.ACCESS_READ)
+            converter = build_subtitle_converter(captions_map)
+            captions_map.close()
+        self.assertEqual(converter.convert('en'), expected)
+
+        with self.assertRaises(InvalidSubtitleFormatError):
+            build_subtitle_converter(u'caf\u00e9'.encode('cp1252'), encoding='utf-8')
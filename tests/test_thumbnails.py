@@ -3,7 +3,9 @@ import os
 import PIL
 import pytest
 
+from pressurecooker import cache
 from pressurecooker import images
+from pressurecooker import thumbscropping
 from pressurecooker import videos
 
 from .test_videos import low_res_video, high_res_video, bad_video, TempFile
@@ -70,6 +72,50 @@ class Test_mp3_thumbnail_generation(BaseThumbnailGeneratorTestCase):
         self.check_16_9_format(output_file)
         # TODO: Store the expected output and compare the contents to the generated file?
 
+    def test_generates_16_9_thumbnail_streaming(self, tmpdir):
+        input_file = os.path.join(files_dir, 'Wilhelm_Scream.mp3')
+        output_file = tmpdir.join('Wilhelm_Screen_thumbnail.png').strpath
+        images.create_waveform_image(input_file, output_file, colormap_options=studio_cmap_options,
+                                     streaming=True)
+        self.check_16_9_format(output_file)
+
+    def test_rejects_unknown_renderer(self, tmpdir):
+        input_file = os.path.join(files_dir, 'Wilhelm_Scream.mp3')
+        output_file = tmpdir.join('Wilhelm_Screen_thumbnail.png').strpath
+        with pytest.raises(ValueError):
+            images.create_waveform_image(input_file, output_file, renderer='svg')
+        assert not os.path.exists(output_file)
+
+    @pytest.mark.parametrize('streaming', [False, True])
+    def test_generates_16_9_thumbnail_with_numpy_renderer(self, tmpdir, streaming):
+        input_file = os.path.join(files_dir, 'Wilhelm_Scream.mp3')
+        output_file = tmpdir.join('Wilhelm_Screen_thumbnail.png').strpath
+        expected_file = tmpdir.join('Wilhelm_Screen_thumbnail_matplotlib.png').strpath
+        images.create_waveform_image(input_file, output_file, colormap_options=studio_cmap_options,
+                                     streaming=streaming, renderer='numpy')
+        images.create_waveform_image(input_file, expected_file, colormap_options=studio_cmap_options,
+                                     streaming=streaming)
+        im = self.check_16_9_format(output_file).convert('RGB')
+        expected = PIL.Image.open(expected_file).convert('RGB')
+        # same background gradient, white margins and waveform color
+        for position in [(55, 30), (55, 195), (5, 5), (200, 112)]:
+            pixel, expected_pixel = im.getpixel(position), expected.getpixel(position)
+            assert all(abs(a - b) <= 8 for a, b in zip(pixel, expected_pixel)), position
+
+    def test_waveform_envelope(self):
+        input_file = os.path.join(files_dir, 'Wilhelm_Scream.mp3')
+        mins, maxs = images.get_waveform_envelope(input_file, width=100)
+        assert len(mins) == len(maxs) == 100
+        assert (mins <= maxs).all()
+        mins, maxs = images.get_waveform_envelope(input_file, width=100, max_num_of_points=320)
+        assert len(mins) == len(maxs) == 10
+
+    def test_raises_for_missing_file_streaming(self, tmpdir):
+        input_file = os.path.join(files_dir, 'file_that_does_not_exist.mp3')
+        output_file = tmpdir.join('thumbnail.png').strpath
+        with pytest.raises(images.ThumbnailGenerationError):
+            images.create_waveform_image(input_file, output_file, streaming=True)
+
     def test_raises_for_missing_file(self, tmpdir):
         input_file = os.path.join(files_dir, 'file_that_does_not_exist.mp3')
         assert not os.path.exists(input_file)
@@ -100,6 +146,18 @@ class Test_pdf_thumbnail_generation(BaseThumbnailGeneratorTestCase):
         images.create_image_from_pdf_page(input_file, output_file, crop='smart')
         self.check_16_9_format(output_file)
 
+    def test_renders_page_at_thumbnail_resolution(self):
+        input_file = os.path.join(files_dir, "generate_thumbnail", "sample.pdf")
+        width, height = images.get_pdf_page_size(input_file)
+        dpi = images.get_pdf_thumbnail_dpi(input_file, zoom=10)
+        assert dpi < images.PDF_MAX_DPI
+        assert width * dpi / 72.0 >= images.THUMBNAIL_SIZE[0] * 1.1
+        assert height * dpi / 72.0 >= images.THUMBNAIL_SIZE[1] * 1.1
+
+    def test_falls_back_to_max_dpi_for_unknown_page_size(self, bad_pdf_file):
+        assert images.get_pdf_page_size(bad_pdf_file.name) is None
+        assert images.get_pdf_thumbnail_dpi(bad_pdf_file.name) == images.PDF_MAX_DPI
+
     def test_raises_for_missing_file(self, tmpdir):
         input_file = os.path.join(files_dir, 'file_that_does_not_exist.pdf')
         assert not os.path.exists(input_file)
@@ -131,6 +189,15 @@ class Test_html_zip_thumbnail_generation(BaseThumbnailGeneratorTestCase):
         r, g, b = im.getpixel((1, 1))
         assert b>g and b>r, (r,g,b)
 
+    def test_get_image_size_reads_headers(self, large_jpeg_file):
+        for input_file in [os.path.join(files_dir, 'thumbnails', 'tootall.png'),
+                           os.path.join(files_dir, 'assets', 'images', '4933759886_098e9acf93_m.jpg'),
+                           large_jpeg_file]:
+            with open(input_file, 'rb') as fhandle:
+                assert images.get_image_size(fhandle) == PIL.Image.open(input_file).size
+        with open(os.path.join(files_dir, 'assets', 'images', 'copyright.txt'), 'rb') as fhandle:
+            assert images.get_image_size(fhandle) is None
+
     def test_raises_for_missing_file(self, tmpdir):
         input_file = os.path.join(files_dir, 'file_that_does_not_exist.zip')
         assert not os.path.exists(input_file)
@@ -167,6 +234,12 @@ class Test_tiled_thumbnail_generation(BaseThumbnailGeneratorTestCase):
         images.create_tiled_image(input_files, output_file)
         self.check_16_9_format(output_file)
 
+    def test_generates_thumbnail_from_prescaled_jpegs(self, tmpdir, large_jpeg_file):
+        input_files = [large_jpeg_file] * 4
+        output_file = tmpdir.join('tiled.png').strpath
+        images.create_tiled_image(input_files, output_file)
+        self.check_16_9_format(output_file)
+
     def test_raises_for_missing_file(self, tmpdir):
         input_file = os.path.join(files_dir, 'file_that_does_not_exist.png')
         assert not os.path.exists(input_file)
@@ -245,6 +318,41 @@ class Test_video_thumbnail_generation(BaseThumbnailGeneratorTestCase):
         self.check_16_9_format(output_file)
         self.check_is_png_file(output_file)
 
+    def test_generates_16_9_thumbnail_with_fast_seek(self, tmpdir, high_res_video):
+        input_file = high_res_video.name
+        output_file = tmpdir.join('fast_seek_thumbnail.png').strpath
+        videos.extract_thumbnail_from_video(input_file, output_file, overwrite=True, fast_seek=True)
+        self.check_16_9_format(output_file)
+        self.check_is_png_file(output_file)
+
+    def test_picks_most_entropic_candidate(self, tmpdir, low_res_video):
+        input_file = low_res_video.name
+        output_file = tmpdir.join('candidates_thumbnail.png').strpath
+        videos.extract_thumbnail_from_video(input_file, output_file, overwrite=True,
+                                            fast_seek=True, candidates=3)
+        self.check_16_9_format(output_file)
+        duration = videos.probe_media(input_file).duration
+        entropies = []
+        for index in range(3):
+            frame_file = tmpdir.join('frame{}.png'.format(index)).strpath
+            videos._extract_frame(input_file, frame_file, duration * (index + 1) / 4)
+            entropies.append(thumbscropping.image_entropy(PIL.Image.open(frame_file)))
+        assert thumbscropping.image_entropy(PIL.Image.open(output_file)) == pytest.approx(max(entropies))
+
+    def test_generates_storyboard(self, tmpdir, low_res_video):
+        input_file = low_res_video.name
+        tiled_file = tmpdir.join('storyboard.png').strpath
+        frames = videos.extract_storyboard_from_video(input_file, tmpdir.strpath, num_frames=4,
+                                                      fpath_tiled=tiled_file)
+        assert 1 <= len(frames) <= 4
+        for frame in frames:
+            self.check_16_9_format(frame)
+        self.check_16_9_format(tiled_file)
+
+    def test_storyboard_raises_for_bad_video(self, tmpdir, bad_video):
+        with pytest.raises(images.ThumbnailGenerationError):
+            videos.extract_storyboard_from_video(bad_video.name, tmpdir.strpath)
+
     def test_raises_for_missing_file(self, tmpdir):
         input_file = os.path.join(files_dir, 'file_that_does_not_exist.mp4')
         assert not os.path.exists(input_file)
@@ -260,6 +368,139 @@ class Test_video_thumbnail_generation(BaseThumbnailGeneratorTestCase):
 
 
 
+class Test_batch_thumbnail_generation(BaseThumbnailGeneratorTestCase):
+
+    def test_generates_thumbnails_and_captures_errors(self, tmpdir):
+        zip_file = os.path.join(files_dir, 'generate_thumbnail', 'sample.zip')
+        epub_file = os.path.join(files_dir, 'generate_thumbnail', 'sample.epub')
+        missing_file = os.path.join(files_dir, 'file_that_does_not_exist.epub')
+        jobs = [
+            ('zip', zip_file, tmpdir.join('zip.png').strpath, None),
+            ('epub', epub_file, tmpdir.join('epub.png').strpath, {'crop': 'smart'}),
+            ('epub', missing_file, tmpdir.join('missing.png').strpath, None),
+            ('docx', epub_file, tmpdir.join('docx.png').strpath, None),
+        ]
+        results = images.create_thumbnails(jobs, max_workers=2)
+        assert results[:2] == [jobs[0][2], jobs[1][2]]
+        self.check_16_9_format(results[0])
+        self.check_16_9_format(results[1])
+        assert isinstance(results[2], images.ThumbnailGenerationError)
+        assert isinstance(results[3], images.ThumbnailGenerationError)
+
+
+class Test_thumbnail_cache(BaseThumbnailGeneratorTestCase):
+
+    def test_reuses_cached_thumbnails(self, tmpdir):
+        input_file = os.path.join(files_dir, 'generate_thumbnail', 'sample.zip')
+        thumbnail_cache = cache.ThumbnailCache(tmpdir.join('cache').strpath)
+        first_file = tmpdir.join('first.png').strpath
+        second_file = tmpdir.join('second.png').strpath
+        thumbnail_cache.generate(images.create_image_from_zip, input_file, first_file)
+        thumbnail_cache.generate(images.create_image_from_zip, input_file, second_file)
+        assert (thumbnail_cache.hits, thumbnail_cache.misses) == (1, 1)
+        self.check_16_9_format(second_file)
+        with open(first_file, 'rb') as first, open(second_file, 'rb') as second:
+            assert first.read() == second.read()
+        # different options are a different thumbnail
+        thumbnail_cache.generate(images.create_image_from_zip, input_file, second_file, crop=',0')
+        assert (thumbnail_cache.hits, thumbnail_cache.misses) == (1, 2)
+
+    def test_evicts_least_recently_used(self, tmpdir):
+        input_file = os.path.join(files_dir, 'generate_thumbnail', 'sample.zip')
+        cache_dir = tmpdir.join('cache').strpath
+        thumbnail_cache = cache.ThumbnailCache(cache_dir, max_size=1)
+        output_file = tmpdir.join('thumbnail.png').strpath
+        thumbnail_cache.generate(images.create_image_from_zip, input_file, output_file)
+        assert os.listdir(cache_dir) == []
+        self.check_16_9_format(output_file)
+
+    def test_tracks_size_without_evicting_below_max_size(self, tmpdir):
+        input_file = os.path.join(files_dir, 'generate_thumbnail', 'sample.zip')
+        cache_dir = tmpdir.join('cache').strpath
+        thumbnail_cache = cache.ThumbnailCache(cache_dir)
+        evictions = []
+        thumbnail_cache.evict = lambda: evictions.append(True)
+        for crop in ['smart', ',0']:
+            thumbnail_cache.generate(images.create_image_from_zip, input_file,
+                                     tmpdir.join('thumbnail.png').strpath, crop=crop)
+        cached_size = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+        assert thumbnail_cache.size == cached_size
+        assert cache.ThumbnailCache(cache_dir).size == cached_size
+        assert evictions == []
+
+    def test_passes_through_errors(self, tmpdir, bad_zip_file):
+        thumbnail_cache = cache.ThumbnailCache(tmpdir.join('cache').strpath)
+        output_file = tmpdir.join('thumbnail.png').strpath
+        with pytest.raises(images.ThumbnailGenerationError):
+            thumbnail_cache.generate(images.create_image_from_zip, bad_zip_file.name, output_file)
+        assert thumbnail_cache.misses == 1
+
+
+class Test_smart_crop_entropy(object):
+
+    # boxes of the greedy smart crop before its entropy computation was optimized
+    @pytest.mark.parametrize('filename, mode, size, expected_box', [
+        ('toowide.png', 'RGB', (250, 164), (125, 0, 375, 164)),
+        ('toowide.png', 'L', (429, 164), (71, 0, 500, 164)),
+        ('toowide.png', 'RGBA', (50, 164), (233, 0, 283, 164)),
+        ('toowide.png', 'RGB', (500, 40), (0, 54, 500, 94)),
+        ('toosquare.png', 'L', (250, 500), (165, 0, 415, 500)),
+        ('toosquare.png', 'RGB', (500, 334), (0, 95, 500, 429)),
+        ('toosquare.png', 'L', (500, 334), (0, 97, 500, 431)),
+        ('toosquare.png', 'RGBA', (500, 40), (0, 214, 500, 254)),
+        ('tootall.png', 'RGB', (150, 461), (91, 0, 241, 461)),
+        ('tootall.png', 'L', (300, 308), (0, 44, 300, 352)),
+        ('tootall.png', 'RGBA', (300, 40), (0, 121, 300, 161)),
+    ])
+    def test_smart_crop_boxes_are_unchanged(self, filename, mode, size, expected_box):
+        im = PIL.Image.open(os.path.join(files_dir, 'thumbnails', filename)).convert(mode)
+        diff_x, diff_y = im.size[0] - size[0], im.size[1] - size[1]
+        box = thumbscropping._smart_crop_box(thumbscropping.SliceEntropy(im), diff_x, diff_y)
+        assert box == expected_box
+        cropped = thumbscropping.scale_and_crop(im, size, crop='smart')
+        assert cropped.tobytes() == im.crop(expected_box).tobytes()
+
+    def test_smart_fast_crop_is_close_to_smart_crop(self):
+        # a wide, flat image with a busy region (columns 2250 to 2925) that
+        # both modes should keep
+        im = PIL.Image.new('RGB', (3600, 225), (200, 200, 200))
+        busy = PIL.Image.open(os.path.join(files_dir, 'thumbnails', 'toosquare.png'))
+        im.paste(busy.convert('RGB').resize((675, 225)), (2250, 0))
+        entropy = thumbscropping.SliceEntropy(im)
+        smart_box = thumbscropping._smart_crop_box(entropy, 3200, 0)
+        fast_box = thumbscropping._smart_fast_crop_box(entropy, 3200, 0)
+        assert fast_box[2] - fast_box[0] == 400
+        assert abs(smart_box[0] - fast_box[0]) <= 3200 * 0.1
+        assert fast_box[2] > 2250 and fast_box[0] < 2925
+        fast = thumbscropping.scale_and_crop(im, (400, 225), crop='smart-fast')
+        assert fast.size == (400, 225)
+
+    def test_smart_fast_window_is_close_to_best_window(self):
+        input_file = os.path.join(files_dir, 'thumbnails', 'toowide.png')
+        im = PIL.Image.open(input_file).convert('RGB')
+        width, height = im.size
+        length = width // 3
+        entropies = [thumbscropping.image_entropy(im.crop((start, 0, start + length, height)))
+                     for start in range(width - length + 1)]
+        start = thumbscropping.SliceEntropy(im).best_columns(length)
+        assert entropies[start] >= max(entropies) - 0.05
+
+    def test_prescale_decodes_jpeg_at_reduced_scale(self, large_jpeg_file):
+        im = PIL.Image.open(large_jpeg_file)
+        im = thumbscropping.prescale_image(im, images.THUMBNAIL_SIZE, crop='smart')
+        width, height = im.size
+        assert width < 3200 and height < 1800
+        assert width >= 400 and height >= 225
+        thumbnail = thumbscropping.scale_and_crop(im, images.THUMBNAIL_SIZE, crop='smart')
+        assert thumbnail.size == images.THUMBNAIL_SIZE
+
+    def test_prescale_ignores_other_formats(self):
+        input_file = os.path.join(files_dir, 'thumbnails', 'toosquare.png')
+        im = PIL.Image.open(input_file)
+        size = im.size
+        assert thumbscropping.prescale_image(im, (40, 40)).size == size
+
+
 
 # FIXTURES
 ################################################################################
@@ -299,3 +540,10 @@ def bad_png_file():
         f.flush()
     return f            # returns a temporary file with a closed file descriptor
 
+@pytest.fixture
+def large_jpeg_file(tmpdir):
+    input_file = os.path.join(files_dir, 'thumbnails', 'toosquare.png')
+    im = PIL.Image.open(input_file).convert('RGB').resize((3200, 1800))
+    output_file = tmpdir.join('large.jpg').strpath
+    im.save(output_file, 'JPEG')
+    return output_file
@@ -121,6 +121,26 @@ def bad_video():
 # TESTS
 ################################################################################
 
+class Test_probe_media:
+
+    def test_returns_media_info(self, low_res_video):
+        info = videos.probe_media(low_res_video.name)
+        assert info.video_codec == 'h264'
+        assert info.audio_codec is not None
+        assert info.duration > 0
+        width, height = info.resolution
+        assert height < 720
+        assert width > height
+        assert info.rotation == 0
+
+    def test_results_are_memoized(self, low_res_video):
+        assert videos.probe_media(low_res_video.name) is videos.probe_media(low_res_video.name)
+
+    def test_raises_for_bad_file(self, bad_video):
+        with pytest.raises(subprocess.CalledProcessError):
+            videos.probe_media(bad_video.name)
+
+
 class Test_check_video_resolution:
 
     def test_returns_a_format_preset(self, low_res_video):
@@ -161,6 +181,14 @@ def get_resolution(videopath):
     return width, height
 
 
+def get_frame_count(videopath):
+    """Helper function to count the frames in the video stream at videopath."""
+    result = subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                                      '-count_packets', '-show_entries', 'stream=nb_read_packets',
+                                      '-of', 'csv=p=0', str(videopath)])
+    return int(result.strip())
+
+
 class Test_compress_video:
 
     def test_compression_works(self, high_res_video):
@@ -200,6 +228,180 @@ class Test_compress_video:
                 videos.compress_video(
                     bad_video.name, vout.name, overwrite=True)
 
+    def test_compliant_video_is_remuxed(self, low_res_video):
+        with TempFile(suffix=".mp4") as compressed, TempFile(suffix=".mp4") as vout:
+            # compressed videos are compliant
+            videos.compress_video(low_res_video.name, compressed.name, overwrite=True)
+            path = videos.compress_video(compressed.name, vout.name,
+                                         overwrite=True, skip_if_compliant=True)
+            assert path == videos.COMPRESSION_REMUXED
+            assert get_resolution(vout.name) == get_resolution(compressed.name)
+
+    def test_stereo_or_high_bitrate_audio_is_not_compliant(self, low_res_video):
+        with TempFile(suffix=".mp4") as stereo, TempFile(suffix=".mp4") as mono:
+            subprocess.check_call(["ffmpeg", "-y", "-v", "error", "-i", low_res_video.name, "-c:v", "copy",
+                                   "-c:a", "aac", "-ac", "2", "-b:a", "128k", stereo.name])
+            subprocess.check_call(["ffmpeg", "-y", "-v", "error", "-i", low_res_video.name, "-c:v", "copy",
+                                   "-c:a", "aac", "-ac", "1", "-b:a", "128k", mono.name])
+            assert not videos.is_compliant_video(stereo.name)
+            assert not videos.is_compliant_video(mono.name)
+            assert videos.is_compliant_video(mono.name, max_audio_bitrate=160)
+
+    def test_non_compliant_video_is_encoded(self, high_res_video):
+        assert not videos.is_compliant_video(high_res_video.name)
+        with TempFile(suffix=".mp4") as vout:
+            path = videos.compress_video(high_res_video.name, vout.name,
+                                         overwrite=True, skip_if_compliant=True)
+            assert path == videos.COMPRESSION_ENCODED
+            width, height = get_resolution(vout.name)
+            assert height == 480
+
+    def test_segmented_compression_works(self, high_res_video):
+        with TempFile(suffix=".mp4") as vout:
+            videos.compress_video(high_res_video.name, vout.name,
+                                  overwrite=True, segments=3, max_workers=2)
+            width, height = get_resolution(vout.name)
+            assert height == 480
+            assert get_frame_count(vout.name) == get_frame_count(high_res_video.name)
+
+    @pytest.mark.parametrize('segments', [1, 3])
+    def test_keeps_existing_target(self, low_res_video, segments):
+        with TempFile(suffix=".mp4") as vout:
+            with open(vout.name, 'wb') as existing:
+                existing.write(b'existing')
+            videos.compress_video(low_res_video.name, vout.name, segments=segments)
+            with open(vout.name, 'rb') as existing:
+                assert existing.read() == b'existing'
+
+    def test_segmented_compression_rejects_progress_callback(self, low_res_video):
+        with TempFile(suffix=".mp4") as vout:
+            with pytest.raises(ValueError):
+                videos.compress_video(low_res_video.name, vout.name, overwrite=True, segments=3,
+                                      progress_callback=lambda progress: None)
+
+    def test_compresses_renditions_in_one_pass(self, high_res_video):
+        with TempFile(suffix=".mp4") as vout1, TempFile(suffix=".mp4") as vout2:
+            outputs = videos.compress_video_renditions(high_res_video.name, [
+                (vout1.name, {'max_height': 360}),
+                (vout2.name, {'max_height': 140, 'crf': 36}),
+            ], overwrite=True)
+            assert outputs == [vout1.name, vout2.name]
+            assert get_resolution(vout1.name)[1] == 360
+            assert get_resolution(vout2.name)[1] == 140
+
+    def test_compression_to_target_size(self, low_res_video):
+        target_size = os.path.getsize(low_res_video.name) // 3
+        with TempFile(suffix=".mp4") as vout:
+            size = videos.compress_video_to_size(low_res_video.name, vout.name, target_size,
+                                                 overwrite=True, max_height=240)
+            assert size == os.path.getsize(vout.name)
+            assert target_size * 0.5 < size <= target_size
+
+    def test_batch_compression_to_total_size(self, low_res_video, bad_video):
+        total_size = os.path.getsize(low_res_video.name) // 3
+        with TempFile(suffix=".mp4") as vout1, TempFile(suffix=".mp4") as vout2:
+            sizes = videos.compress_videos_to_size([
+                (low_res_video.name, vout1.name, {'max_height': 240}),
+                (bad_video.name, vout2.name, None),
+            ], total_size, overwrite=True)
+            assert sizes[0] <= total_size
+            assert isinstance(sizes[1], videos.VideoCompressionError)
+
+    def test_segmented_compression_rejects_target_size(self, low_res_video):
+        with TempFile(suffix=".mp4") as vout:
+            with pytest.raises(ValueError):
+                videos.compress_video(low_res_video.name, vout.name, overwrite=True, segments=3,
+                                      target_size=os.path.getsize(low_res_video.name) // 3)
+
+    def test_raises_for_impossible_target_size(self, low_res_video):
+        with pytest.raises(videos.VideoCompressionError):
+            videos.get_target_video_bitrate(low_res_video.name, 1000)
+
+    def test_reports_progress_and_metrics(self, low_res_video):
+        progress, metrics = [], []
+        with TempFile(suffix=".mp4") as vout:
+            videos.compress_video(low_res_video.name, vout.name, overwrite=True, max_height=140,
+                                  progress_callback=progress.append, metrics_callback=metrics.append)
+            assert progress[-1]['done']
+            assert progress[-1]['out_time'] > 0
+            assert progress[-1]['frame'] == get_frame_count(vout.name)
+            assert len(metrics) == 1
+            assert metrics[0].path == videos.COMPRESSION_ENCODED
+            assert metrics[0].output_size == os.path.getsize(vout.name)
+            assert metrics[0].compression_ratio > 1
+            assert metrics[0].wall_time > 0
+
+    def test_compliance_respects_max_height(self, low_res_video):
+        with TempFile(suffix=".mp4") as compressed:
+            videos.compress_video(low_res_video.name, compressed.name, overwrite=True)
+            assert videos.is_compliant_video(compressed.name)
+            assert not videos.is_compliant_video(compressed.name, max_height=100)
+
+
+class Test_batch_video_compression:
+
+    def test_compresses_all_jobs(self, low_res_video, bad_video):
+        with TempFile(suffix=".mp4") as vout1, TempFile(suffix=".mp4") as vout2:
+            results = videos.compress_videos([
+                (low_res_video.name, vout1.name, {'max_height': 140}),
+                (bad_video.name, vout2.name, None),
+            ], max_workers=2, overwrite=True)
+            assert results[0] == videos.COMPRESSION_ENCODED
+            assert get_resolution(vout1.name)[1] == 140
+            assert isinstance(results[1], videos.VideoCompressionError)
+
+    def test_skips_existing_targets(self, low_res_video):
+        with TempFile(suffix=".mp4") as vout:
+            results = videos.compress_videos([(low_res_video.name, vout.name, None)])
+            assert results == [videos.COMPRESSION_SKIPPED]
+
+    def test_priority_and_cancellation(self, low_res_video):
+        with TempFile(suffix=".mp4") as vout1, TempFile(suffix=".mp4") as vout2:
+            queue = videos.VideoCompressionQueue(max_workers=1, overwrite=True)
+            low = queue.add(low_res_video.name, vout1.name, max_height=140)
+            cancelled = queue.add(low_res_video.name, vout2.name, max_height=140)
+            high = queue.add(low_res_video.name, vout2.name, priority=1, max_height=140)
+            assert queue.cancel(cancelled)
+            assert not queue.cancel(cancelled)
+            results = queue.run()
+            assert list(results) == [cancelled, high, low]
+            assert results[cancelled] == videos.COMPRESSION_CANCELLED
+
+
+class Test_compress_audio:
+
+    audio_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files', 'Wilhelm_Scream.mp3')
+
+    @pytest.mark.parametrize('suffix,codec', [('.m4a', 'aac'), ('.mp3', 'mp3')])
+    def test_compression_works(self, suffix, codec):
+        with TempFile(suffix=suffix) as aout:
+            path = videos.compress_audio(self.audio_file, aout.name, overwrite=True)
+            assert path == videos.COMPRESSION_ENCODED
+            info = videos.probe_media(aout.name)
+            assert info.audio_codec == codec
+            assert info.channels == 1
+            assert info.sample_rate == videos.DEFAULT_AUDIO_SAMPLE_RATE
+            assert os.path.getsize(aout.name) < os.path.getsize(self.audio_file)
+
+    def test_compliant_audio_is_copied(self):
+        with TempFile(suffix=".mp3") as aout, TempFile(suffix=".mp3") as aout2:
+            videos.compress_audio(self.audio_file, aout.name, overwrite=True)
+            assert not videos.is_compliant_audio(self.audio_file, aout2.name)
+            assert videos.is_compliant_audio(aout.name, aout2.name)
+            path = videos.compress_audio(aout.name, aout2.name, overwrite=True, skip_if_compliant=True)
+            assert path == videos.COMPRESSION_REMUXED
+
+    def test_batch_compression(self, bad_video):
+        with TempFile(suffix=".m4a") as aout1, TempFile(suffix=".m4a") as aout2:
+            os.remove(aout1.name)
+            results = videos.compress_audio_files([
+                (self.audio_file, aout1.name, {'bitrate': 24}),
+                (self.audio_file, aout2.name, None),
+                (bad_video.name, aout1.name + '.m4a', None),
+            ], max_workers=2)
+            assert results[:2] == [videos.COMPRESSION_ENCODED, videos.COMPRESSION_SKIPPED]
+            assert isinstance(results[2], videos.VideoCompressionError)
+
 
 class Test_convert_video:
 